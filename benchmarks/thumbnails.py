@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Thumbnail pipeline benchmark: per-image time and peak RSS of the old
+# full-decode pipeline against elfinder._createThumbnails, which the
+# connector runs for every image (content digest included).
+#
+# usage: python benchmarks/thumbnails.py [image_dir] [-n COUNT] [-s SIZE]
+# Without image_dir COUNT synthetic 24 megapixel JPEGs are generated.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import resource
+import subprocess
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+
+def legacy(path, out, size, fmt, quality):
+    """Pipeline as it was: full decode, crop, thumbnail, PNG"""
+    from PIL import Image
+    from elfinder import _cropTuple
+    im = Image.open(path).copy()
+    box = _cropTuple(im.size)
+    if box:
+        im = im.crop(box)
+    im.thumbnail((size, size),
+                 getattr(Image, 'ANTIALIAS', getattr(Image, 'LANCZOS', 1)))
+    im.save(os.path.join(out, 'tmb.png'), 'PNG')
+
+
+def current(path, out, size, fmt, quality):
+    from elfinder import _createThumbnails
+    digest, error = _createThumbnails(path, out, [size], fmt, quality)
+    if error:
+        raise RuntimeError(error)
+
+
+def run(pipeline, images, size, fmt, quality):
+    """Child process: thumbnail every image, print 'ms_per_image rss_mb'"""
+    func = {'legacy': legacy, 'current': current}[pipeline]
+    out = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        for i, path in enumerate(images):
+            # a directory per image, so identical sources are not skipped
+            tmbDir = os.path.join(out, str(i))
+            os.mkdir(tmbDir)
+            func(path, tmbDir, size, fmt, quality)
+        elapsed = (time.time() - start) * 1000 / len(images)
+    finally:
+        shutil.rmtree(out)
+    print('%.1f %.1f' % (elapsed, peak_rss() / 1048576.0))
+
+
+def peak_rss():
+    """Peak RSS in bytes; ru_maxrss survives exec on Linux, VmHWM not"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+def generate(directory, count):
+    from PIL import Image
+    images = []
+    for i in range(count):
+        path = os.path.join(directory, 'img%d.jpg' % i)
+        Image.linear_gradient('L').resize((6000, 4000)).convert('RGB')\
+            .rotate(i * 7).save(path, 'JPEG', quality=90)
+        images.append(path)
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?')
+    parser.add_argument('-n', '--count', type=int, default=5)
+    parser.add_argument('-s', '--size', type=int, default=48)
+    parser.add_argument('-q', '--quality', type=int, default=85)
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    parser.add_argument('images', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        pipeline, fmt, size = args.child
+        images = ([args.directory] if args.directory else []) + args.images
+        return run(pipeline, images, int(size), fmt, args.quality)
+
+    tmp = None
+    if args.directory:
+        images = sorted(os.path.join(args.directory, f)
+                        for f in os.listdir(args.directory))
+    else:
+        tmp = tempfile.mkdtemp()
+        images = generate(tmp, args.count)
+
+    try:
+        print('%-8s %-5s %12s %12s' % ('pipeline', 'fmt', 'ms/image',
+                                       'peak RSS MB'))
+        for pipeline, fmt in (('legacy', 'png'), ('current', 'png'),
+                              ('current', 'jpeg'), ('current', 'webp')):
+            out = subprocess.check_output(
+                [sys.executable, __file__, '--child', pipeline, fmt,
+                 str(args.size), '-q', str(args.quality)] + images)
+            ms, rss = out.decode().split()
+            print('%-8s %-5s %12s %12s' % (pipeline, fmt, ms, rss))
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
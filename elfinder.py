@@ -6,12 +6,483 @@
 import os
 import re
 import sys
+import json
+import stat
 import time
+import errno
 import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import hmac
+import atexit
+import base64
 import hashlib
 import mimetypes
 import collections
 from datetime import datetime
+from contextlib import closing
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Clone open file src into open file dst, False if unsupported"""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _copyData(src, dst, size):
+    """Copy size bytes from src to dst, in the kernel where possible"""
+    done = 0
+    for func in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, func):
+            continue
+        try:
+            while done < size:
+                if func == 'copy_file_range':
+                    n = os.copy_file_range(src.fileno(), dst.fileno(),
+                                           size - done, done, done)
+                else:
+                    n = os.sendfile(dst.fileno(), src.fileno(), done,
+                                    size - done)
+                if not n:  # src shrank meanwhile
+                    return done
+                done += n
+            return done
+        except OSError:
+            if done:
+                raise
+    while True:
+        chunk = src.read(1048576)
+        if not chunk:
+            return done
+        dst.write(chunk)
+        done += len(chunk)
+
+
+def _copyFile(src, dst):
+    """Copy contents and mode of regular file src to new dst"""
+    if not stat.S_ISREG(os.stat(src).st_mode):
+        raise OSError(errno.EINVAL, 'Not a regular file', src)
+    with open(src, 'rb') as s:
+        size = os.fstat(s.fileno()).st_size
+        with open(dst, 'wb') as d:
+            if not _reflink(s, d):
+                size = _copyData(s, d, size)
+    shutil.copymode(src, dst)
+    return size
+
+
+# _zipStream needs ZipInfo.from_file(strict_timestamps=), ZipInfo.is_dir()
+# and ZipFile.open(mode='w') on an unseekable file
+_zipStreamable = sys.version_info >= (3, 8)
+
+
+def _builtinArchivers():
+    """In-process (create, extract) archivers by mimetype"""
+    formats = {'application/x-tar': {'builtin': 'tar', 'ext': 'tar'}}
+    try:
+        import zlib  # noqa: F401 (zip deflate and gzip)
+        formats['application/zip'] = {'builtin': 'zip', 'ext': 'zip'}
+        formats['application/x-gzip'] = {'builtin': 'gz', 'ext': 'tar.gz'}
+    except ImportError:
+        pass
+    try:
+        import bz2  # noqa: F401
+        formats['application/x-bzip2'] = {'builtin': 'bz2', 'ext': 'tar.bz2'}
+    except ImportError:
+        pass
+    create = dict(formats)
+    if not _zipStreamable:
+        create.pop('application/zip', None)
+    return create, formats
+
+
+class _StreamBuffer(object):
+    """Write-only, unseekable file that collects what zipfile writes"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _zipStream(entries, chunkSize=65536):
+    """Yield a zip archive of (path, arcname) entries as it is built"""
+    out = _StreamBuffer()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as zf:
+        for path, arcname in entries:
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname,
+                                                  strict_timestamps=False)
+            except OSError:
+                continue
+            if zinfo.is_dir():
+                zf.writestr(zinfo, b'')
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as src:
+                    with zf.open(zinfo, 'w', force_zip64=(
+                            zinfo.file_size > 1 << 30)) as dst:
+                        while True:
+                            chunk = src.read(chunkSize)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            data = out.drain()
+                            if data:
+                                yield data
+            data = out.drain()
+            if data:
+                yield data
+    yield out.drain()
+
+
+def _writeArchive(f, entries, fmt):
+    """Write (path, arcname) entries to file object f as zip or tar"""
+    if fmt == 'zip':
+        for data in _zipStream(entries):
+            f.write(data)
+        return
+    mode = 'w|' + ('' if fmt == 'tar' else fmt)
+    with closing(tarfile.open(fileobj=f, mode=mode)) as tf:
+        for path, arcname in entries:
+            tf.add(path, arcname, recursive=False)
+
+
+def _extractArchive(path, dest, fmt):
+    """Extract archive path into dest, return the names placed there"""
+    tmp = tempfile.mkdtemp(prefix='.extract-', dir=dest)
+    try:
+        if fmt == 'zip':
+            # zipfile strips absolute paths and '..' components itself
+            with closing(zipfile.ZipFile(path)) as zf:
+                zf.extractall(tmp)
+        else:
+            with closing(tarfile.open(path, 'r:*')) as tf:
+                if hasattr(tarfile, 'data_filter'):
+                    tf.extractall(tmp, filter='data')
+                else:
+                    members = []
+                    for m in tf:
+                        parts = m.name.replace('\\', '/').split('/')
+                        if (m.isreg() or m.isdir()) and '..' not in parts \
+                                and not os.path.isabs(m.name):
+                            members.append(m)
+                    tf.extractall(tmp, members)
+        clash = _mergeClash(tmp, dest)
+        if clash is not None:
+            raise OSError(errno.EEXIST, 'File or folder with the same name '
+                          'already exists', clash)
+        names = os.listdir(tmp)
+        _mergeTree(tmp, dest)
+    finally:
+        shutil.rmtree(tmp, True)
+    return names
+
+
+def _isRealDir(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+
+def _mergeClash(src, dst):
+    """First path of dst where file and directory clash with src"""
+    for name in os.listdir(src):
+        s, d = os.path.join(src, name), os.path.join(dst, name)
+        if _isRealDir(s) and _isRealDir(d):
+            clash = _mergeClash(s, d)
+            if clash is not None:
+                return clash
+        elif os.path.lexists(d) and (_isRealDir(s) or _isRealDir(d)):
+            return d
+    return None
+
+
+def _mergeTree(src, dst):
+    """Rename the contents of directory src into directory dst"""
+    for name in os.listdir(src):
+        s, d = os.path.join(src, name), os.path.join(dst, name)
+        if _isRealDir(s) and _isRealDir(d):
+            _mergeTree(s, d)
+        else:
+            _replace(s, d)
+
+
+def _replace(src, dst):
+    """os.replace(), os.rename() where that is missing (Python 2)"""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.lexists(dst) \
+                and not os.path.isdir(dst):
+            os.unlink(dst)
+        os.rename(src, dst)
+
+
+def _writeStores(jobs):
+    """Write (filename, data) pairs as JSON, return the failures"""
+    failed = []
+    for fname, data in jobs:
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='.store-',
+                                       dir=os.path.dirname(fname))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            _replace(tmp, fname)
+        except Exception as e:
+            failed.append((fname, str(e)))
+            try:
+                if tmp is not None:
+                    os.unlink(tmp)
+            except OSError:
+                pass
+    return failed
+
+
+def _cropTuple(size):
+    w, h = size
+    if w > h:  # landscape
+        l = int((w - h) / 2)
+        u = 0
+        r = l + h
+        d = h
+        return (l, u, r, d)
+    elif h > w:  # portrait
+        l = 0
+        u = int((h - w) / 2)
+        r = w
+        d = u + w
+        return (l, u, r, d)
+    else:  # cube
+        pass
+
+    return False
+
+
+_tmbFormats = {
+    'png': ('PNG', 'png'),
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp')
+}
+
+
+_tmbLegacy = re.compile(r'^[0-9a-f]{32}\.png$')  # <md5 of path>.png
+
+
+def _tmbName(digest, size, fmt):
+    """Thumbnail file name for content digest at size"""
+    return '%s_%d.%s' % (digest, size, _tmbFormats[fmt][1])
+
+
+def _thumbnailSource(path, size):
+    """Open image cropped to a square, shrunk to at least size"""
+    from PIL import Image
+    src = Image.open(path)
+    try:
+        if src.format == 'JPEG':
+            src.draft(src.mode, (size, size))
+        src.load()
+        box = _cropTuple(src.size)
+        im = src.crop(box) if box else src.copy()
+    finally:
+        src.close()
+
+    if im.mode in ('P', 'PA'):
+        im = im.convert('RGBA')
+    elif im.mode == 'CMYK':
+        im = im.convert('RGB')
+    factor = min(im.size) // (size * 2)
+    if factor > 1 and hasattr(im, 'reduce'):
+        im = im.reduce(factor)
+    return im
+
+
+def _saveThumbnail(im, tmb, size, fmt='png', quality=85):
+    """Resample im down to size and write it atomically to tmb"""
+    from PIL import Image
+    resample = getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', 1))
+    im = im.copy()
+    im.thumbnail((size, size), resample)
+
+    fmt = _tmbFormats[fmt][0]
+    if fmt != 'PNG' and im.mode not in ('RGB', 'L') and not (
+            fmt == 'WEBP' and im.mode == 'RGBA'):
+        im = im.convert('RGBA' if fmt == 'WEBP' else 'RGB')
+    # unique per writer, threads of one process may make the same tmb
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(tmb))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if fmt == 'PNG':
+                im.save(f, fmt)
+            else:
+                im.save(f, fmt, quality=quality)
+        os.chmod(tmp, 0o644)
+        _replace(tmp, tmb)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def _createThumbnails(path, tmbDir, sizes, fmt='png', quality=85,
+                      digest=None):
+    """Create the thumbnail set of path, return (digest, error)"""
+    todo = sizes
+    try:
+        if digest is None:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+            digest = h.hexdigest()
+            todo = [size for size in sizes if not os.path.exists(
+                os.path.join(tmbDir, _tmbName(digest, size, fmt)))]
+
+        if todo:
+            src = _thumbnailSource(path, max(todo))
+            for size in sorted(todo, reverse=True):
+                _saveThumbnail(src, os.path.join(
+                    tmbDir, _tmbName(digest, size, fmt)), size, fmt, quality)
+    except Exception as e:
+        return digest, str(e)
+    return digest, None
+
+
+class fileResponse(object):
+    """File body for the 'file' response item, a byte range of path"""
+
+    chunkSize = 65536
+
+    def __init__(self, path, offset=0, length=None):
+        self.path = path
+        self.offset = offset
+        self._file = open(path, 'rb')
+        if length is None:
+            length = os.fstat(self._file.fileno()).st_size - offset
+        self.length = length
+        self._pos = 0
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.read(self.chunkSize)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def read(self, size=-1):
+        left = self.length - self._pos
+        if size is None or size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return b''
+        self._file.seek(self.offset + self._pos)
+        chunk = self._file.read(size)
+        self._pos += len(chunk)
+        return chunk
+
+    def sendfile(self, sock):
+        """Send the remaining bytes to socket sock, return bytes sent"""
+        sent = 0
+        if hasattr(os, 'sendfile'):
+            try:
+                while self._pos < self.length:
+                    n = os.sendfile(sock.fileno(), self._file.fileno(),
+                                    self.offset + self._pos,
+                                    self.length - self._pos)
+                    if not n:
+                        break
+                    self._pos += n
+                    sent += n
+                self.close()
+                return sent
+            except OSError:
+                if sent:
+                    raise
+        for chunk in self:
+            sock.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    def close(self):
+        self._file.close()
+
+
+class streamResponse(object):
+    """Body for the 'file' response item produced by an iterator"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def __iter__(self):
+        try:
+            if self._buf:
+                yield self._buf
+                self._buf = b''
+            for chunk in self._chunks:
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size is None or size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
 
 
 class connector():
@@ -23,18 +494,50 @@ class connector():
         'rootAlias': 'Home',
         'dotFiles': False,
         'dirSize': True,
+        'dirSizeTTL': 300,  # seconds before a cached size is re-checked
+        'dirSizeDefer': False,  # leave unknown sizes to the dirsize command
+        'dirSizeWorkers': 4,
+        'dirSizeTime': 2,  # seconds one dirsize request may wait
+        'treeDepth': 0,  # levels sent besides the path to cwd, 0 - all
         'fileMode': 644,
         'dirMode': 755,
         'imgLib': 'auto',
         'tmbDir': '.tmb',
         'tmbAtOnce': 5,
+        'tmbProcesses': 0,  # > 0 or 'auto' to use a process pool
+        'tmbTime': 1,  # seconds one tmb request waits for the pool
         'tmbSize': 48,
+        'tmbSizes': {},  # extra sizes by name, e.g. {'grid': 128}
+        'tmbFormat': 'png',  # png, jpeg or webp
+        'tmbQuality': 85,
+        'tmbMaxBytes': 0,  # thumbnail cache limits, 0 - unlimited
+        'tmbMaxCount': 0,
+        'tmbSweepInterval': 60,  # seconds between background GC rounds
+        'tmbSweepBatch': 500,
+        'imgDimsBackground': False,  # off-request, listings flag imgdims
+        'cacheDir': False,
+        'cacheFlushInterval': 10,  # seconds between background store writes
+        'listingETag': False,  # validators for open listings, needs cacheDir
+        'hashMode': 'md5',  # or 'path', requires hashSecret
+        'hashSecret': '',
         'fileURL': True,
-        'uploadMaxSize': 256,
+        'sendfile': False,  # 'X-Sendfile' or 'X-Accel-Redirect'
+        'sendfileURL': '',  # internal location for X-Accel-Redirect
+        'uploadMaxSize': 256,  # MB per request
+        'uploadMaxFileSize': 0,  # MB per file, 0 for uploadMaxSize only
         'uploadWriteChunk': 8192,
+        'uploadChunkDir': False,  # e.g. '.uploads', enables chunked upload
+        'uploadChunkTTL': 86400,  # seconds an idle partial upload is kept
+        'dedup': False,  # 'hardlink' or 'reflink' identical content
+        'copyWorkers': 4,  # threads copying files for paste and duplicate
+        'trash': False,  # e.g. '.trash', rm moves targets there
+        'trashRetention': 0,  # seconds trashed items can be restored
+        'archiveBuiltin': True,  # zip/tar via zipfile/tarfile, no commands
         'uploadAllow': [],
         'uploadDeny': [],
         'uploadOrder': ['deny', 'allow'],
+        'mimeCacheSize': 10000,
+        'mimeSniff': False,  # read magic bytes of files without known ext
         # 'aclObj': None, # TODO
         # 'aclRole': 'user', # TODO
         'defaults': {
@@ -68,6 +571,11 @@ class connector():
         'archive': '__archive',
         'resize': '__resize',
         'tmb': '__thumbnails',
+        'dirsize': '__dirSizes',
+        'tree': '__subtree',
+        'uploadstatus': '__uploadStatus',
+        'restore': '__restore',
+        'zipdl': '__zipDownload',
         'ping': '__ping'
     }
 
@@ -98,6 +606,25 @@ class connector():
         'mkv': 'video/x-matroska'
     }
 
+    _mimeMagic = [
+        (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+        (0, b'\xff\xd8\xff', 'image/jpeg'),
+        (0, b'GIF87a', 'image/gif'),
+        (0, b'GIF89a', 'image/gif'),
+        (8, b'WEBP', 'image/webp'),
+        (0, b'%PDF-', 'application/pdf'),
+        (0, b'PK\x03\x04', 'application/zip'),
+        (0, b'\x1f\x8b', 'application/x-gzip'),
+        (0, b'BZh', 'application/x-bzip2'),
+        (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+        (0, b'Rar!\x1a\x07', 'application/x-rar'),
+        (257, b'ustar', 'application/x-tar'),
+        (0, b'OggS', 'application/ogg'),
+        (0, b'\x1a\x45\xdf\xa3', 'video/x-matroska'),
+        (0, b'ID3', 'audio/mpeg'),
+        (0, b'\x7fELF', 'application/x-executable')
+    ]
+
     _time = 0
     _request = {}
     _response = {}
@@ -108,10 +635,34 @@ class connector():
     _today = 0
     _yesterday = 0
 
+    # process-wide stores, see __store()
+    _stores = {}
+    _storesDirty = set()
+    _storesFlushed = {}
+    _storeDirs = {}
+    _storeLock = threading.RLock()
+    _pools = {}
+    _sizeJobs = {}
+    _sizeRefresh = set()
+    _dimJobs = set()
+    _tmbJobs = {}
+    _manifestBuilt = set()
+    _sweepState = {}
+    _chunkSweep = {}
+    _trashPurge = {}
+    _archiverTools = None
+    _treeCache = {}
+    _mimeTable = None
+    _mimeCache = collections.OrderedDict()
+    _sniffCache = collections.OrderedDict()
+
     # public variables
     httpAllowedParameters = ('cmd', 'target', 'targets[]', 'current', 'tree',
                              'name', 'content', 'src', 'dst', 'cut', 'init',
-                             'type', 'width', 'height', 'upload[]')
+                             'type', 'width', 'height', 'upload[]',
+                             'uploadId', 'chunk', 'chunks')
+    httpAllowedHeaders = ('range', 'if-range', 'if-none-match',
+                          'if-modified-since')
     # return variables
     httpStatusCode = 0
     httpHeader = {}
@@ -129,6 +680,10 @@ class connector():
         self.__debug('URL', self._options['URL'])
         self.__debug('root', self._options['root'])
 
+        self._perms = self.__compilePerms()
+        self._optionsTag = hashlib.md5(repr(sorted(
+            self._options.items())).encode('utf-8')).hexdigest()[:8]
+
         for cmd in self._options['disabled']:
             if cmd in self._commands:
                 del self._commands[cmd]
@@ -140,15 +695,43 @@ class connector():
                 os.makedirs(thumbs_dir)  # self._options['tmbDir'] = False
             self._options['tmbDir'] = thumbs_dir
 
+        if self._options['cacheDir']:
+            cache_dir = os.path.join(self._options['root'],
+                                     self._options['cacheDir'])
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            self._options['cacheDir'] = cache_dir
+
+        if self._options['uploadChunkDir']:
+            chunk_dir = os.path.join(self._options['root'],
+                                     self._options['uploadChunkDir'])
+            if not os.path.exists(chunk_dir):
+                os.makedirs(chunk_dir)
+            self._options['uploadChunkDir'] = chunk_dir
+
+        if self._options['trash']:
+            trash_dir = os.path.join(self._options['root'],
+                                     self._options['trash'])
+            if not os.path.exists(trash_dir):
+                os.makedirs(trash_dir)
+            self._options['trash'] = trash_dir
+
     def __reset(self):
         """Flush per request variables"""
         self.httpStatusCode = 0
         self.httpHeader = {}
         self.httpResponse = None
         self._request = {}
+        self._requestHeader = {}
+        self._partial = False
+        self._generationDirty = False
+        self._dedupSaved = {'files': 0, 'bytes': 0}
+        self._copied = {'files': 0, 'bytes': 0}
         self._response = {}
         self._errorData = {}
         self._form = {}
+        self._dirWritable = {}
+        self._allowed = {}
 
         self._time = time.time()
         t = datetime.fromtimestamp(self._time)
@@ -157,14 +740,25 @@ class connector():
 
         self._response['debug'] = {}
 
-    def run(self, httpRequest=[]):
+    def run(self, httpRequest=[], httpRequestHeader=None):
         """main function"""
         self.__reset()
+        # accept both 'If-Range' and WSGI style 'HTTP_IF_RANGE' names
+        for name, value in (httpRequestHeader or {}).items():
+            name = name.lower().replace('_', '-')
+            if name.startswith('http-'):
+                name = name[5:]
+            if name in self.httpAllowedHeaders:
+                self._requestHeader[name] = value
         rootOk = True
         if not os.path.exists(self._options['root']) \
                 or self._options['root'] == '':
             rootOk = False
             self._response['error'] = 'Invalid backend configuration'
+        elif self._options['hashMode'] == 'path' \
+                and not self._options['hashSecret']:
+            rootOk = False
+            self._response['error'] = 'Invalid backend configuration'
         elif not self.__isAllowed(self._options['root'], 'read'):
             rootOk = False
             self._response['error'] = 'Access denied'
@@ -179,14 +773,8 @@ class connector():
                     cmd = self._commands[self._request['cmd']]
                     func = getattr(self, '_' + self.__class__.__name__ + cmd,
                                    None)
-                    if (sys.version_info > (3, 0)):
-                        # Python 3 code in this block
-                        is_callable = isinstance(func, collections.Callable)
-                    else:
-                        # Python 2 code in this block
-                        is_callable = callable(func)
-
-                    if is_callable:
+                    # collections.Callable is gone since Python 3.10
+                    if callable(func):
                         try:
                             func()
                         except Exception as e:
@@ -197,7 +785,7 @@ class connector():
             else:
                 self.__open()
 
-            if 'init' in self._request:
+            if 'init' in self._request and self.httpStatusCode != 304:
                 self.__checkArchivers()
                 self._response['disabled'] = self._options['disabled']
                 if not self._options['fileURL']:
@@ -207,6 +795,7 @@ class connector():
                 self._response['params'] = {
                     'dotFiles': self._options['dotFiles'],
                     'uplMaxSize': str(self._options['uploadMaxSize']) + 'M',
+                    'uplChunked': bool(self._options['uploadChunkDir']),
                     'archives': list(
                         self._options['archivers']['create'].keys()),
                     'extract': list(
@@ -214,6 +803,19 @@ class connector():
                     'url': url
                 }
 
+        if self._generationDirty:
+            self.__bumpGeneration()
+        if rootOk is True:
+            self.__tmbSweepSchedule()
+            self.__trashPurgeSchedule()
+        self.__flushStores()
+
+        if self._copied['files']:
+            self._response['copied'] = self._copied
+
+        if self._dedupSaved['files']:
+            self._response['dedup'] = self._dedupSaved
+
         if self._errorData:
             self._response['errorData'] = self._errorData
 
@@ -279,6 +881,12 @@ class connector():
             else:
                 disp = 'attachments'
 
+            fst = os.stat(curFile)
+            size = fst.st_size
+            etag = '"%x-%x-%x"' % (fst.st_ino, int(getattr(
+                fst, 'st_mtime_ns', fst.st_mtime * 1e9)), size)
+            if self.__notModified(etag, fst.st_mtime):
+                return
             self.httpStatusCode = 200
             self.httpHeader['Content-type'] = mime
             self.httpHeader['Content-Disposition'] = disp + '; filename='\
@@ -286,9 +894,41 @@ class connector():
             self.httpHeader['Content-Location'] = curFile.replace(
                 self._options['root'], '')
             self.httpHeader['Content-Transfer-Encoding'] = 'binary'
-            self.httpHeader['Content-Length'] = str(os.lstat(curFile).st_size)
-            self.httpHeader['Connection'] = 'close'
-            self._response['file'] = open(curFile, 'r')
+            self.httpHeader['Accept-Ranges'] = 'bytes'
+
+            sendfile = self._options['sendfile']
+            if sendfile:
+                # the front server reads the file and handles Range itself
+                if sendfile.lower() == 'x-accel-redirect':
+                    rel = curFile[len(self._options['root']):].replace(
+                        os.sep, '/')
+                    self.httpHeader['X-Accel-Redirect'] = \
+                        self._options['sendfileURL'].rstrip('/') + \
+                        quote(rel.encode('utf-8'), '/')
+                else:
+                    self.httpHeader['X-Sendfile'] = curFile
+                # empty body, nothing to open
+                self._response['file'] = streamResponse([])
+                return
+
+            offset, length = 0, size
+            if 'range' in self._requestHeader \
+                    and self.__ifRange(etag, fst.st_mtime):
+                byteRange = self.__byteRange(
+                    self._requestHeader['range'], size)
+                if byteRange is False:
+                    self.httpStatusCode = 416
+                    self.httpHeader['Content-Range'] = 'bytes */%d' % size
+                    self.httpHeader['Content-type'] = 'text/html'
+                    self.httpResponse = 'Requested range not satisfiable'
+                    return
+                if byteRange is not None:
+                    offset, length = byteRange
+                    self.httpStatusCode = 206
+                    self.httpHeader['Content-Range'] = 'bytes %d-%d/%d' % (
+                        offset, offset + length - 1, size)
+            self.httpHeader['Content-Length'] = str(length)
+            self._response['file'] = fileResponse(curFile, offset, length)
             return
         # try dir
         else:
@@ -303,7 +943,107 @@ class connector():
                 else:
                     path = target
 
+            if self.__listingNotModified(path):
+                return
             self.__content(path, 'tree' in self._request)
+            if self._partial:
+                # thumbnails or sizes still pending, do not let it be cached
+                self.httpHeader.pop('ETag', None)
+                self.httpHeader.pop('Last-Modified', None)
+
+    def __listingNotModified(self, path):
+        """Set listing validators, True if the client's copy is current"""
+        if not self._options['listingETag'] or not self._options['cacheDir'] \
+                or 'error' in self._response or 'tree' in self._request:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        generation, changed = self.__generation()
+        since = self._today
+        if self._options['dirSize']:
+            ttl = max(int(self._options['dirSizeTTL']), 1)
+            since = max(since, int(time.time()) // ttl * ttl)
+        tag = hashlib.md5(' '.join(
+            [self._optionsTag, str(since), str('init' in self._request),
+             generation, self.__statKey(st)]).encode('utf-8'))
+        mtime = max(since, changed, st.st_mtime)
+        if self.__notModified('W/"%s"' % tag.hexdigest()[:16], mtime):
+            return True
+        self.httpHeader['Cache-Control'] = 'no-cache'
+        return False
+
+    def __generation(self):
+        """Listing generation token and when it was set, ('', 0) if none"""
+        try:
+            with open(os.path.join(self._options['cacheDir'],
+                                   'generation.json')) as f:
+                generation, changed = json.load(f)
+            return str(generation), float(changed)
+        except (IOError, OSError, ValueError, TypeError):
+            return '', 0
+
+    def __bumpGeneration(self):
+        """Set a new listing generation in cacheDir after a change"""
+        if not self._options['listingETag'] or not self._options['cacheDir']:
+            return
+        token = base64.b16encode(os.urandom(8)).decode('ascii')
+        failed = _writeStores([(os.path.join(
+            self._options['cacheDir'], 'generation.json'),
+            [token, time.time()])])
+        if failed:
+            self.__debug('generation', failed[0][1])
+
+    def __notModified(self, etag, mtime):
+        """Set ETag/Last-Modified, answer 304 if the request matches them"""
+        self.httpHeader['ETag'] = etag
+        self.httpHeader['Last-Modified'] = formatdate(mtime, usegmt=True)
+        match = self._requestHeader.get('if-none-match')
+        since = self._requestHeader.get('if-modified-since')
+        if match is not None:
+            # weak comparison, as RFC 7232 asks for If-None-Match
+            tags = [re.sub('^W/', '', t.strip()) for t in match.split(',')]
+            current = '*' in tags or re.sub('^W/', '', etag) in tags
+        elif since:
+            since = parsedate_tz(since)
+            current = since is not None and int(mtime) <= mktime_tz(since)
+        else:
+            current = False
+        if current:
+            self.httpStatusCode = 304
+        return current
+
+    def __ifRange(self, etag, mtime):
+        """True if a Range request may be served partially"""
+        cond = self._requestHeader.get('if-range')
+        if not cond:
+            return True
+        cond = cond.strip()
+        if cond.startswith('"') or cond.startswith('W/'):
+            return cond == etag
+        cond = parsedate_tz(cond)
+        return cond is not None and int(mtime) == mktime_tz(cond)
+
+    def __byteRange(self, header, size):
+        """Parse Range into (offset, length), None: whole file, False: 416"""
+        m = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', header)
+        if not m or m.group(1) == m.group(2) == '':
+            return None
+        if m.group(1) == '':
+            length = min(int(m.group(2)), size)
+            if not length:
+                return False
+            return size - length, length
+        start = int(m.group(1))
+        end = size - 1
+        if m.group(2) != '':
+            end = min(int(m.group(2)), size - 1)
+            if end < start:
+                return None
+        if start >= size:
+            return False
+        return start, end - start + 1
 
     def __rename(self):
         """Rename file or dir"""
@@ -331,9 +1071,9 @@ class connector():
             self._response['error'] = 'File or folder with the same name' +\
                 'already exists'
         else:
-            self.__rmTmb(curName)
             try:
                 os.rename(curName, newName)
+                self.__changed(newName, origin=curName)
                 self._response['select'] = [self.__hash(newName)]
                 self.__content(curDir, os.path.isdir(newName))
             except:
@@ -362,6 +1102,7 @@ class connector():
         else:
             try:
                 os.mkdir(newDir, int(self._options['dirMode']))
+                self.__changed(newDir)
                 self._response['select'] = [self.__hash(newDir)]
                 self.__content(path, True)
             except:
@@ -389,6 +1130,7 @@ class connector():
         else:
             try:
                 open(newFile, 'w').close()
+                self.__changed(newFile)
                 self._response['select'] = [self.__hash(newFile)]
                 self.__content(curDir, False)
             except:
@@ -414,7 +1156,12 @@ class connector():
             rmFile = self.__find(rm, curDir)
             if not rmFile:
                 continue
-            self.__remove(rmFile)
+            trashed = self._options['trash'] and self.__trash(rmFile)
+            if trashed is None:
+                continue
+            if not trashed:
+                self.__remove(rmFile)
+            self.__changed(rmFile, True)
         # TODO if errorData not empty return error
         self.__content(curDir, True)
 
@@ -447,53 +1194,48 @@ class connector():
                 self._response['error'] = 'Invalid parameters'
                 return
 
+            if 'uploadId' in self._request:
+                self.__uploadChunk(curDir, upFiles)
+                return
+
             self._response['select'] = []
             total = 0
             upSize = 0
             maxSize = self._options['uploadMaxSize'] * 1024 * 1024
+            maxFileSize = self._options['uploadMaxFileSize'] * 1024 * 1024
             for name, data in upFiles.items():
                 if name:
                     total += 1
                     name = os.path.basename(name)
                     if not self.__checkName(name):
                         self.__errorData(name, 'Invalid name')
-                    else:
-                        name = os.path.join(curDir, name)
-                        try:
-                            f = open(name, 'wb',
-                                     self._options['uploadWriteChunk'])
-                            for chunk in self.__fbuffer(data):
-                                f.write(chunk)
-                            f.close()
-                            upSize += os.lstat(name).st_size
-                            if self.__isUploadAllow(name):
-                                os.chmod(name, self._options['fileMode'])
-                                self._response['select'].append(
-                                    self.__hash(name)
-                                )
-                            else:
-                                self.__errorData(name, 'Not allowed file type')
-                                try:
-                                    os.unlink(name)
-                                except:
-                                    pass
-                        except:
+                        continue
+                    name = os.path.join(curDir, name)
+                    if not self.__isUploadAllow(name):
+                        self.__errorData(name, 'Not allowed file type')
+                        continue
+                    limit = maxSize - upSize
+                    if maxFileSize and maxFileSize < limit:
+                        limit = maxFileSize
+                    try:
+                        size = self.__saveUpload(data, name, limit)
+                    except Exception as e:
+                        self.__debug('uploadFailed', str(e))
+                        self.__errorData(name, 'Unable to save uploaded file')
+                        continue
+                    if size is None:
+                        if maxFileSize and limit == maxFileSize:
                             self.__errorData(
                                 name,
-                                'Unable to save uploaded file')
-                        if upSize > maxSize:
-                            try:
-                                os.unlink(name)
-                                self.__errorData(
-                                    name,
-                                    'File exceeds the maximum allowed filesize'
-                                )
-                            except:
-                                # TODO ?
-                                self.__errorData(
-                                    name,
-                                    'File was only partially uploaded')
-                            break
+                                'File exceeds the maximum allowed filesize')
+                        else:
+                            self.__errorData(
+                                name,
+                                'Upload exceeds the maximum allowed size')
+                        continue
+                    upSize += size
+                    self.__changed(name)
+                    self._response['select'].append(self.__hash(name))
 
             if self._errorData:
                 if len(self._errorData) == total:
@@ -504,6 +1246,319 @@ class connector():
             self.__content(curDir, False)
             return
 
+    def __uploadChunk(self, curDir, upFiles):
+        """Store one chunk of a resumable upload, assemble when complete"""
+        try:
+            chunk = int(self._request.get('chunk'))
+            chunks = int(self._request.get('chunks'))
+        except (TypeError, ValueError):
+            chunk = chunks = -1
+        partDir = self.__chunkPath(self._request['uploadId'])
+        if not partDir or not 0 <= chunk < chunks or len(upFiles) != 1:
+            self._response['error'] = 'Invalid parameters'
+            return
+        self.__chunkSweepSchedule()
+
+        name, data = list(upFiles.items())[0]
+        name = os.path.basename(name)
+        if not self.__checkName(name):
+            self._response['error'] = 'Invalid name'
+            return
+        target = os.path.join(curDir, name)
+        if not self.__isUploadAllow(target):
+            self._response['error'] = 'Not allowed file type'
+            return
+
+        meta = {'name': name, 'current': self._request['current'],
+                'chunks': chunks}
+        metaFile = os.path.join(partDir, 'upload.json')
+        try:
+            try:
+                with open(metaFile) as f:
+                    have = json.load(f)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                have = self.__chunkStart(partDir, meta)
+        except (IOError, OSError, ValueError):
+            self._response['error'] = 'Unable to save uploaded file'
+            return
+        if have != meta:
+            self._response['error'] = 'Invalid parameters'
+            return
+
+        limit = self._options['uploadMaxSize'] * 1024 * 1024
+        maxFileSize = self._options['uploadMaxFileSize'] * 1024 * 1024
+        if maxFileSize:
+            have = sum(os.path.getsize(os.path.join(partDir, str(n)))
+                       for n in self.__chunksHave(partDir) if n != chunk)
+            limit = min(limit, maxFileSize - have)
+        try:
+            size = self.__saveUpload(data, os.path.join(partDir, str(chunk)),
+                                     limit, False)
+        except Exception as e:
+            self.__debug('uploadFailed', str(e))
+            self._response['error'] = 'Unable to save uploaded file'
+            return
+        if size is None:
+            self._response['error'] = \
+                'File exceeds the maximum allowed filesize'
+            return
+        os.utime(metaFile, None)
+
+        have = self.__chunksHave(partDir)
+        if len(have) < chunks:
+            self._response['uploadId'] = self._request['uploadId']
+            self._response['chunks'] = have
+            return
+        try:
+            if not self.__assembleChunks(partDir, chunks, target):
+                # another request got the last chunk first
+                self._response['uploadId'] = self._request['uploadId']
+                self._response['chunks'] = have
+                return
+        except Exception as e:
+            self.__debug('uploadFailed', str(e))
+            self._response['error'] = 'Unable to save uploaded file'
+            return
+        self.__changed(target)
+        self._response['select'] = [self.__hash(target)]
+        self.__content(curDir, False)
+
+    def __uploadStatus(self):
+        """Chunk numbers received so far for uploadId"""
+        curDir = None
+        if 'current' in self._request:
+            curDir = self.__findDir(self._request['current'], None)
+        partDir = self.__chunkPath(self._request.get('uploadId'))
+        if not curDir or not partDir:
+            self._response['error'] = 'Invalid parameters'
+            return
+        if not self.__isAllowed(curDir, 'write'):
+            self._response['error'] = 'Access denied'
+            return
+        have = []
+        try:
+            with open(os.path.join(partDir, 'upload.json')) as f:
+                if json.load(f)['current'] == self._request['current']:
+                    have = self.__chunksHave(partDir)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self._response['uploadId'] = self._request['uploadId']
+        self._response['chunks'] = have
+
+    def __chunkStart(self, partDir, meta):
+        """Create partDir with its upload.json atomically, return meta"""
+        chunkDir = os.path.dirname(partDir)
+        try:
+            os.makedirs(chunkDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = tempfile.mkdtemp(prefix='.new-', dir=chunkDir)
+        try:
+            with open(os.path.join(tmp, 'upload.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp, partDir)
+            return meta
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        finally:
+            shutil.rmtree(tmp, True)
+        with open(os.path.join(partDir, 'upload.json')) as f:
+            return json.load(f)
+
+    def __chunkPath(self, uploadId):
+        """Directory of partial upload uploadId, False if not possible"""
+        if not self._options['uploadChunkDir'] or not uploadId \
+                or not re.match(r'^[A-Za-z0-9_-]{1,64}$', str(uploadId)):
+            return False
+        return os.path.join(self._options['uploadChunkDir'], str(uploadId))
+
+    def __chunksHave(self, partDir):
+        try:
+            return sorted(int(n) for n in os.listdir(partDir) if n.isdigit())
+        except OSError:
+            return []
+
+    def __assembleChunks(self, partDir, chunks, name):
+        """Join chunks 0..chunks-1 of partDir into name"""
+        work = partDir + '.assembling'
+        try:
+            os.rename(partDir, work)
+        except OSError:
+            return False
+        chunkSize = self._options['uploadWriteChunk']
+        tmp = None
+        done = False
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='.upload-', suffix='.part',
+                                       dir=os.path.dirname(name))
+            digest = hashlib.sha256() if self._options['dedup'] else None
+            with os.fdopen(fd, 'wb') as f:
+                for n in range(chunks):
+                    with open(os.path.join(work, str(n)), 'rb') as part:
+                        for chunk in self.__fbuffer(part, chunkSize):
+                            f.write(chunk)
+                            if digest is not None:
+                                digest.update(chunk)
+            self.__placeUpload(tmp, name, digest)
+            tmp = None
+            done = True
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+            if not done:
+                os.rename(work, partDir)
+        shutil.rmtree(work, True)
+        return True
+
+    def __chunkSweepSchedule(self):
+        """Queue removal of partial uploads idle for uploadChunkTTL"""
+        chunkDir = self._options['uploadChunkDir']
+        ttl = self._options['uploadChunkTTL']
+        with self._storeLock:
+            if self._time - self._chunkSweep.get(chunkDir, 0) < ttl / 10.0:
+                return
+            self._chunkSweep[chunkDir] = self._time
+        self.__pool('chunkgc', 1).apply_async(
+            self.__chunkSweep, (chunkDir, self._time - ttl))
+
+    def __chunkSweep(self, chunkDir, before):
+        for name in os.listdir(chunkDir):
+            path = os.path.join(chunkDir, name)
+            try:
+                meta = os.path.join(path, 'upload.json')
+                if not os.path.exists(meta):
+                    meta = path
+                if os.stat(meta).st_mtime < before:
+                    shutil.rmtree(path, True)
+            except OSError:
+                pass
+
+    def __saveUpload(self, data, name, limit, dedup=True):
+        """Stream file object data to name, return its size or None"""
+        chunkSize = self._options['uploadWriteChunk']
+        digest = None
+        if dedup and self._options['dedup']:
+            digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(prefix='.upload-', suffix='.part',
+                                   dir=os.path.dirname(name))
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb', chunkSize) as f:
+                for chunk in self.__fbuffer(data, chunkSize):
+                    size += len(chunk)
+                    if size > limit:
+                        size = None
+                        break
+                    f.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+            if size is not None:
+                self.__placeUpload(tmp, name, digest)
+                tmp = None
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+        return size
+
+    def __placeUpload(self, tmp, name, digest=None):
+        """Rename temp file tmp to name, deduplicated by sha256 digest"""
+        os.chmod(tmp, self._options['fileMode'])
+        first = True
+        if digest is not None:
+            digest = digest.hexdigest()
+            linked = self.__dedupLink(tmp, digest, name)
+            if linked == name:
+                return
+            if linked:
+                tmp, first = linked, False
+        _replace(tmp, name)
+        if digest is not None and first:
+            with self._storeLock:
+                self.__store('dedup')[digest] = [
+                    name[len(self._options['root']) + 1:],
+                    self.__statKey(os.stat(name))]
+                self.__storeDirty('dedup')
+
+    def __dedupLink(self, tmp, digest, name):
+        """Link or clone the stored copy of digest, False if none usable"""
+        entry = self.__store('dedup').get(digest)
+        if not entry:
+            return False
+        src = self.__rootPath(os.sep + entry[0])
+        if not src:
+            return False
+        try:
+            st = os.stat(src)
+            tst = os.stat(tmp)
+            if self.__statKey(st) != entry[1] or st.st_dev != tst.st_dev \
+                    or not stat.S_ISREG(st.st_mode):
+                return False
+            if os.path.isfile(name) and os.path.samefile(src, name):
+                os.unlink(tmp)
+                return name
+            if self._options['dedup'] == 'reflink':
+                with open(src, 'rb') as s:
+                    with open(tmp, 'r+b') as d:
+                        if not _reflink(s, d):
+                            return False
+                linked = tmp
+            else:
+                linked = tmp + '.link'
+                os.link(src, linked)
+                os.unlink(tmp)
+        except (IOError, OSError):
+            return False
+        self.__dedupCount(tst.st_size)
+        return linked
+
+    def __dedupCopy(self, src, dst):
+        """Copy regular file src to dst by hardlink or reflink"""
+        if not self._options['dedup'] or os.path.islink(src) \
+                or not os.path.isfile(src):
+            return False
+        try:
+            if self._options['dedup'] == 'reflink':
+                with open(src, 'rb') as s:
+                    with open(dst, 'wb') as d:
+                        cloned = _reflink(s, d)
+                if not cloned:
+                    os.unlink(dst)
+                    return False
+                shutil.copymode(src, dst)
+            else:
+                os.link(src, dst)
+        except (IOError, OSError):
+            return False
+        self.__dedupCount(os.stat(dst).st_size)
+        return True
+
+    def __dedupCount(self, size):
+        with self._storeLock:
+            self._dedupSaved['files'] += 1
+            self._dedupSaved['bytes'] += size
+
+    def __unshare(self, path):
+        """Give a hardlinked path its own inode before writing in place"""
+        if self._options['dedup'] != 'hardlink' \
+                or os.stat(path).st_nlink < 2:
+            return
+        fd, tmp = tempfile.mkstemp(prefix='.unshare-',
+                                   dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with open(path, 'rb') as s:
+                    shutil.copyfileobj(s, f)
+            shutil.copystat(path, tmp)
+            _replace(tmp, path)
+            tmp = None
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+
     def __paste(self):
         """Copy or cut files/directories"""
         if (
@@ -551,24 +1606,29 @@ class connector():
                 if cut:
                     if not self.__isAllowed(f, 'rm'):
                         self._response['error'] = 'Move failed'
-                        self._errorData(f, 'Access denied')
+                        self.__errorData(f, 'Access denied')
                         self.__content(curDir, True)
                         return
-                    # TODO thumbs
                     if os.path.exists(newDst):
                         self._response['error'] = 'Unable to move files'
-                        self._errorData(
+                        self.__errorData(
                             f,
                             'File or folder with the same name already exists')
                         self.__content(curDir, True)
                         return
                     try:
-                        os.rename(f, newDst)
-                        self.__rmTmb(f)
+                        try:
+                            os.rename(f, newDst)
+                        except OSError as e:
+                            # src and dst on different mounts
+                            if e.errno != errno.EXDEV \
+                                    or not self.__moveAcross(f, newDst):
+                                raise
+                        self.__changed(newDst, origin=f)
                         continue
                     except:
                         self._response['error'] = 'Unable to move files'
-                        self._errorData(f, 'Unable to move')
+                        self.__errorData(f, 'Unable to move')
                         self.__content(curDir, True)
                         return
                 else:
@@ -576,6 +1636,7 @@ class connector():
                         self._response['error'] = 'Unable to copy files'
                         self.__content(curDir, True)
                         return
+                    self.__changed(newDst)
                     continue
             self.__content(curDir, True)
         else:
@@ -600,6 +1661,7 @@ class connector():
             if not self.__copy(target, newName):
                 self._response['error'] = 'Unable to create file copy'
                 return
+            self.__changed(newName)
 
         self.__content(curDir, True)
         return
@@ -633,9 +1695,11 @@ class connector():
         self.__debug('resize ' + curFile, str(width) + ':' + str(height))
         self.__initImgLib()
         try:
+            self.__unshare(curFile)
             im = self._im.open(curFile)
             imResized = im.resize((width, height), self._im.ANTIALIAS)
             imResized.save(curFile)
+            self.__changed(curFile)
         except Exception as e:
             # self.__debug('resizeFailed_' + path, str(e))
             self.__debug('resizeFailed_' + self._options['root'], str(e))
@@ -656,43 +1720,192 @@ class connector():
             return False
 
         self.__initImgLib()
-        if self.__canCreateTmb():
-            if self._options['tmbAtOnce'] > 0:
-                tmbMax = self._options['tmbAtOnce']
-            else:
-                tmbMax = 5
-            self._response['current'] = self.__hash(curDir)
-            self._response['images'] = {}
-            i = 0
-            for f in os.listdir(curDir):
-                path = os.path.join(curDir, f)
-                fhash = self.__hash(path)
-                if (
-                        self.__canCreateTmb(path) and
-                        self.__isAllowed(path, 'read')
-                ):
-                    tmb = os.path.join(self._options['tmbDir'], fhash + '.png')
-                    if not os.path.exists(tmb):
-                        if self.__tmb(path, tmb):
-                            self._response['images'].update({
-                                fhash: self.__path2url(tmb)
-                            })
-                            i += 1
-                if i >= tmbMax:
-                    self._response['tmb'] = True
-                    break
-        else:
+        if not self.__canCreateTmb():
             return False
 
+        self._response['current'] = self.__hash(curDir)
+        self._response['images'] = {}
+        missing = []
+        for f, path, st, tst in self.__scandir(curDir):
+            if (
+                    tst is None or
+                    not stat.S_ISREG(tst.st_mode) or
+                    not self.__isAccepted(f) or
+                    not self.__canCreateTmb(path) or
+                    not self.__isAllowed(path, 'read', tst)
+            ):
+                continue
+            key = self.__statKey(tst)
+            digest = self.__tmbDigest(path, key)
+            if (
+                    key in self._tmbJobs or
+                    not digest or
+                    not self.__tmbExists(digest, tst)
+            ):
+                missing.append((self.__hash(path), path, key))
+
+        if self._options['tmbProcesses']:
+            self.__thumbnailsPool(missing)
+            return
+
+        if self._options['tmbAtOnce'] > 0:
+            tmbMax = self._options['tmbAtOnce']
+        else:
+            tmbMax = 5
+        for fhash, path, key in missing[:tmbMax]:
+            digest = self.__tmb(path, key)
+            if digest:
+                self._response['images'][fhash] = self.__path2url(
+                    self.__tmbFile(digest))
+        if len(missing) > tmbMax:
+            self._response['tmb'] = True
+
         return
 
+    def __thumbnailsPool(self, missing):
+        """Create thumbnails in the tmb pool, answer within tmbTime"""
+        processes = self._options['tmbProcesses']
+        if processes == 'auto':
+            processes = None
+        pool = self.__pool('tmb', processes, True)
+
+        jobs = []
+        with self._storeLock:
+            for fhash, path, key in missing:
+                if key not in self._tmbJobs:
+                    self._tmbJobs[key] = pool.apply_async(
+                        _createThumbnails,
+                        (path, self._options['tmbDir'], self.__tmbSizes(),
+                         self._options['tmbFormat'],
+                         self._options['tmbQuality'],
+                         self.__tmbPathDigest(path)))
+                jobs.append((fhash, path, key, self._tmbJobs[key]))
+
+        deadline = time.time() + self._options['tmbTime']
+        for fhash, path, key, job in jobs:
+            job.wait(max(0, deadline - time.time()))
+            if not job.ready():
+                self._response['tmb'] = True
+                continue
+            with self._storeLock:
+                self._tmbJobs.pop(key, None)
+            if job.successful():
+                digest, error = job.get()
+            else:
+                digest, error = None, 'worker failed'
+            digest = self.__tmbDone(path, key, digest, error)
+            if digest:
+                self._response['images'][fhash] = self.__path2url(
+                    self.__tmbFile(digest))
+
+    def __dirSizes(self):
+        """Compute pending directory sizes in the background"""
+        if 'current' not in self._request:
+            self._response['error'] = 'Invalid parameters'
+            return
+        curDir = self.__findDir(self._request['current'], None)
+        if not curDir or not self.__isAllowed(curDir, 'read'):
+            self._response['error'] = 'Invalid parameters'
+            return
+
+        # the entries __info defers, symlinked directories included
+        dirs = dict((self.__hash(pf), pf)
+                    for f, pf, st, tst in self.__scandir(curDir)
+                    if tst is not None and stat.S_ISDIR(tst.st_mode) and
+                    self.__isAccepted(f))
+        if 'targets[]' in self._request:
+            targets = self._request['targets[]']
+            if not isinstance(targets, list):
+                targets = [targets]
+            dirs = dict((h, dirs[h]) for h in targets if h in dirs)
+
+        keys = {}
+        for fhash, path in dirs.items():
+            key = self.__sizeJobKey(path)
+            if key is not None:
+                keys[fhash] = key
+
+        pool = self.__pool('dirsize', self._options['dirSizeWorkers'])
+        jobs = {}
+        with self._storeLock:
+            for fhash, key in keys.items():
+                path = dirs[fhash]
+                entry = self._sizeJobs.get(path)
+                if entry is None or entry[0] != key and entry[1].ready():
+                    entry = (key, pool.apply_async(
+                        self.__aggregateSize, (path,)))
+                    self._sizeJobs[path] = entry
+                jobs[fhash] = (path, entry)
+
+        deadline = time.time() + self._options['dirSizeTime']
+        self._response['current'] = self.__hash(curDir)
+        self._response['sizes'] = {}
+        for fhash, (path, entry) in jobs.items():
+            key, job = entry
+            job.wait(max(0, deadline - time.time()))
+            if not job.ready():
+                self._response['dirsize'] = True
+                continue
+            with self._storeLock:
+                if self._sizeJobs.get(path) is entry:
+                    del self._sizeJobs[path]
+            if key != keys[fhash]:
+                # queued for an older state, the next request requeues
+                self._response['dirsize'] = True
+            elif job.successful():
+                self._response['sizes'][fhash] = job.get()
+
+    def __sizeJobKey(self, path):
+        """Directory stat and dirSizeTTL period a size job is valid for"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        ttl = max(int(self._options['dirSizeTTL']), 1)
+        return '%s:%d' % (self.__statKey(st), int(time.time()) // ttl)
+
+    def __pool(self, name, size, processes=False):
+        """Process-wide thread (or process) pool `name`"""
+        with self._storeLock:
+            if name not in self._pools:
+                if processes:
+                    import multiprocessing
+                    if size is not None:
+                        size = max(1, int(size))
+                    context = multiprocessing
+                    if hasattr(multiprocessing, 'get_context'):
+                        # forking next to the running thread pools can
+                        # leave a lock held in the child
+                        methods = multiprocessing.get_all_start_methods()
+                        context = multiprocessing.get_context(
+                            'forkserver' if 'forkserver' in methods
+                            else 'spawn')
+                    self._pools[name] = context.Pool(size)
+                else:
+                    from multiprocessing.pool import ThreadPool
+                    self._pools[name] = ThreadPool(max(1, int(size)))
+            return self._pools[name]
+
     def __content(self, path, tree):
         """CWD + CDC + maybe(TREE)"""
         self.__cwd(path)
         self.__cdc(path)
 
         if tree:
-            self._response['tree'] = self.__tree(self._options['root'])
+            self._response['tree'] = self.__tree(self._options['root'],
+                                                 cwd=path)
+
+    def __subtree(self):
+        """Expand a single tree node"""
+        path = None
+        if 'target' in self._request:
+            path = self.__findDir(self._request['target'], None)
+        if not path:
+            self._response['error'] = 'Invalid parameters'
+        elif not self.__isAllowed(path, 'read'):
+            self._response['error'] = 'Access denied'
+        else:
+            self._response['tree'] = self.__tree(path)
 
     def __cwd(self, path):
         """Current Working Directory"""
@@ -729,14 +1942,13 @@ class connector():
         files = []
         dirs = []
 
-        for f in sorted(os.listdir(path)):
+        for f, pf, st, tst in self.__scandir(path):
             if not self.__isAccepted(f):
                 continue
-            pf = os.path.join(path, f)
-            info = {}
-            info = self.__info(pf)
-            info['hash'] = self.__hash(pf)
+            info = self.__info(pf, st, tst)
             if info['mime'] == 'directory':
+                if stat.S_ISDIR(st.st_mode):
+                    self.__indexAdd(pf, info['hash'])
                 dirs.append(info)
             else:
                 files.append(info)
@@ -744,23 +1956,26 @@ class connector():
         dirs.extend(files)
         self._response['cdc'] = dirs
 
-    def __info(self, path):
-        # mime = ''
+    def __info(self, path, st=None, tst=None):
+        """File info, st/tst are lstat/stat results when already known"""
+        if st is None:
+            st = os.lstat(path)
+            tst = self.__followStat(path, st)
+
         filetype = 'file'
-        if os.path.isfile(path):
+        if tst is not None and stat.S_ISREG(tst.st_mode):
             filetype = 'file'
-        elif os.path.isdir(path):
+        elif tst is not None and stat.S_ISDIR(tst.st_mode):
             filetype = 'dir'
-        elif os.path.islink(path):
+        elif stat.S_ISLNK(st.st_mode):
             filetype = 'link'
 
-        stat = os.lstat(path)
-        statDate = datetime.fromtimestamp(stat.st_mtime)
+        statDate = datetime.fromtimestamp(st.st_mtime)
 
         fdate = ''
-        if stat.st_mtime >= self._today:
+        if st.st_mtime >= self._today:
             fdate = 'Today ' + statDate.strftime("%H:%M")
-        elif stat.st_mtime >= self._yesterday and stat.st_mtime < self._today:
+        elif st.st_mtime >= self._yesterday and st.st_mtime < self._today:
             fdate = 'Yesterday ' + statDate.strftime("%H:%M")
         else:
             fdate = statDate.strftime("%d %b %Y %H:%M")
@@ -768,14 +1983,21 @@ class connector():
         info = {
             'name': self.__checkUtf8(os.path.basename(path)),
             'hash': self.__hash(path),
-            'mime': 'directory' if filetype == 'dir' else self.__mimetype(path),
+            'mime': 'directory' if filetype == 'dir'
+                    else self.__mimetype(path, tst),
             'date': fdate,
-            'size': self.__dirSize(path) if filetype == 'dir' else stat.st_size,
-            'read': self.__isAllowed(path, 'read'),
-            'write': self.__isAllowed(path, 'write'),
-            'rm': self.__isAllowed(path, 'rm')
+            'size': self.__dirSize(path) if filetype == 'dir' else st.st_size,
+            'read': self.__isAllowed(path, 'read', tst),
+            'write': self.__isAllowed(path, 'write', tst),
+            'rm': self.__isAllowed(path, 'rm', tst)
         }
 
+        if info['size'] is None:
+            info['size'] = 0
+            info['sizePending'] = True
+            self._response['dirsize'] = True
+            self._partial = True
+
         if filetype == 'link':
             lpath = self.__readlink(path)
             if not lpath:
@@ -809,58 +2031,154 @@ class connector():
                     info['url'] = self.__path2url(path)
             if info['mime'][0:5] == 'image':
                 if self.__canCreateTmb():
-                    dim = self.__getImgSize(path)
+                    dim = self.__getImgSize(path, tst)
                     if dim:
                         info['dim'] = dim
                         info['resize'] = True
+                    elif dim is None:
+                        # read in the background, open again for it
+                        info['dimPending'] = True
+                        self._response['imgdims'] = True
 
                     # if we are in tmb dir, files are thumbs itself
                     if os.path.dirname(path) == self._options['tmbDir']:
                         info['tmb'] = self.__path2url(path)
                         return info
 
-                    tmb = os.path.join(
-                        self._options['tmbDir'],
-                        info['hash'] + '.png'
-                    )
-
-                    if os.path.exists(tmb):
-                        tmbUrl = self.__path2url(tmb)
-                        info['tmb'] = tmbUrl
+                    digest = self.__tmbDigest(path, self.__statKey(tst))
+                    if digest and self.__tmbExists(digest, tst, True):
+                        info['tmb'] = self.__path2url(self.__tmbFile(digest))
+                        if self._options['tmbSizes']:
+                            info['tmbs'] = dict(
+                                (name, self.__path2url(
+                                    self.__tmbFile(digest, size)))
+                                for name, size
+                                in self._options['tmbSizes'].items())
                     else:
                         self._response['tmb'] = True
+                        self._partial = True
 
         return info
 
-    def __tree(self, path):
-        """Return directory tree starting from path"""
+    def __scandir(self, path):
+        """Sorted (name, path, lstat, stat) of directory entries"""
+        entries = []
+        if scandir is not None:
+            it = scandir(path)
+            try:
+                for e in it:
+                    try:
+                        entries.append((e.name, e.path,
+                                        e.stat(follow_symlinks=False)))
+                    except OSError:
+                        pass
+            finally:
+                if hasattr(it, 'close'):
+                    it.close()
+        else:
+            for name in os.listdir(path):
+                pf = os.path.join(path, name)
+                try:
+                    entries.append((name, pf, os.lstat(pf)))
+                except OSError:
+                    pass
 
-        if not os.path.isdir(path):
+        entries.sort(key=lambda e: e[0])
+        return [(name, pf, st, self.__followStat(pf, st))
+                for name, pf, st in entries]
+
+    def __subdirs(self, path):
+        """Sorted names of real (non-link) subdirectories"""
+        if scandir is None:
+            return sorted(d for d in os.listdir(path)
+                          if os.path.isdir(os.path.join(path, d)) and
+                          not os.path.islink(os.path.join(path, d)))
+        names = []
+        it = scandir(path)
+        try:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        names.append(e.name)
+                except OSError:
+                    pass
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+        return sorted(names)
+
+    def __cachedSubdirs(self, path, st=None):
+        """__subdirs() through the process-wide tree cache"""
+        rec = self.__treeRecord(path, st)
+        if rec[1] is None:
+            rec[1] = self.__subdirs(path)
+        return rec[1]
+
+    def __treeRecord(self, path, st=None):
+        """[key, subdirs, node] of path in the tree cache"""
+        if st is None:
+            st = os.lstat(path)
+        key = (st.st_ino, getattr(st, 'st_mtime_ns', st.st_mtime),
+               getattr(st, 'st_ctime_ns', st.st_ctime), self._optionsTag)
+        rec = self._treeCache.get(path)
+        if rec is None or rec[0] != key:
+            rec = [key, None, None]
+            self._treeCache[path] = rec
+        return rec
+
+    def __followStat(self, path, st):
+        """stat() for links, lstat result itself otherwise"""
+        if not stat.S_ISLNK(st.st_mode):
+            return st
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def __tree(self, path, depth=None, cwd=None):
+        """Directory tree from path, treeDepth levels plus the way to cwd"""
+        if depth is None:
+            depth = self._options['treeDepth']
+            if not depth:
+                depth = -1
+
+        try:
+            st = os.lstat(path)
+        except OSError:
             return ''
-        if os.path.islink(path):
+        if not stat.S_ISDIR(st.st_mode):
             return ''
 
-        if path == self._options['root'] and self._options['rootAlias']:
-            name = self._options['rootAlias']
+        rec = self.__treeRecord(path, st)
+        if rec[2] is None:
+            if path == self._options['root'] and self._options['rootAlias']:
+                name = self._options['rootAlias']
+            else:
+                name = os.path.basename(path)
+            rec[2] = {
+                'hash': self.__hash(path),
+                'name': self.__checkUtf8(name),
+                'read': self.__isAllowed(path, 'read', st),
+                'write': self.__isAllowed(path, 'write', st)
+            }
+        tree = dict(rec[2], dirs=[])
+        self.__indexAdd(path, tree['hash'])
+
+        if cwd is not None and self._options['treeDepth'] and (
+                cwd == path or cwd.startswith(path + os.sep)):
+            depth = max(depth, self._options['treeDepth'])
+
+        if tree['read']:
+            dirs = [d for d in self.__cachedSubdirs(path, st)
+                    if self.__isAccepted(d)]
+            if depth != 0:
+                for d in dirs:
+                    tree['dirs'].append(self.__tree(
+                        os.path.join(path, d), depth - 1, cwd))
         else:
-            name = os.path.basename(path)
-        tree = {
-            'hash': self.__hash(path),
-            'name': self.__checkUtf8(name),
-            'read': self.__isAllowed(path, 'read'),
-            'write': self.__isAllowed(path, 'write'),
-            'dirs': []
-        }
-
-        if self.__isAllowed(path, 'read'):
-            for d in sorted(os.listdir(path)):
-                pd = os.path.join(path, d)
-                if (
-                        os.path.isdir(pd) and
-                        not os.path.islink(pd) and
-                        self.__isAccepted(d)
-                ):
-                    tree['dirs'].append(self.__tree(pd))
+            dirs = []
+        if self._options['treeDepth']:
+            tree['hasDirs'] = bool(dirs)
 
         return tree
 
@@ -917,12 +2235,140 @@ class connector():
 
         return
 
+    def __trash(self, target):
+        """Move target into the trash, False to remove it, None if refused"""
+        if not self.__isAllowed(target, 'rm'):
+            self.__errorData(target, 'Access denied')
+            return None
+        if self._perms.get('rm') is not None and os.path.isdir(target) \
+                and not os.path.islink(target):
+            # perms may deny rm somewhere below target
+            for dirpath, dirnames, filenames in os.walk(target):
+                for name in dirnames + filenames:
+                    path = os.path.join(dirpath, name)
+                    if not self.__isAllowed(path, 'rm'):
+                        self.__errorData(path, 'Access denied')
+                        return None
+
+        item = tempfile.mkdtemp(prefix='%d-' % self._time,
+                                dir=self._options['trash'])
+        try:
+            with open(os.path.join(item, '.trashinfo'), 'w') as f:
+                json.dump({'path': target[len(self._options['root']):]}, f)
+            if not os.path.isdir(target):
+                self.__rmTmb(target)
+            os.rename(target, os.path.join(item, os.path.basename(target)))
+        except OSError as e:
+            shutil.rmtree(item, True)
+            if e.errno == errno.EXDEV:
+                return False
+            self.__errorData(target, 'Remove failed')
+            return None
+        self.__trashPurgeSchedule(True)
+        if self._options['trashRetention']:
+            self._response.setdefault('trash', {})[self.__hash(target)] = \
+                os.path.basename(item)
+        return True
+
+    def __restore(self):
+        """Move items back from the trash to where they were removed"""
+        items = self._request.get('targets[]')
+        if not self._options['trash'] or not items:
+            self._response['error'] = 'Invalid parameters'
+            return
+        if not isinstance(items, list):
+            items = [items]
+
+        self._response['select'] = []
+        for name in items:
+            if not re.match(r'^\d+-\w+$', str(name)):
+                self.__errorData(str(name), 'Invalid parameters')
+                continue
+            item = os.path.join(self._options['trash'], name)
+            try:
+                with open(os.path.join(item, '.trashinfo')) as f:
+                    rel = json.load(f)['path']
+                path = self.__trashOrigin(rel)
+            except (IOError, OSError, ValueError, KeyError, TypeError,
+                    AttributeError):
+                self.__errorData(name, 'File not found')
+                continue
+            if path is None:
+                # .trashinfo is a plain file in the root, do not trust it
+                self.__errorData(name, 'Invalid parameters')
+                continue
+            if not self.__isAllowed(os.path.dirname(path), 'write'):
+                self.__errorData(path, 'Access denied')
+                continue
+            if os.path.lexists(path):
+                self.__errorData(
+                    path, 'File or folder with the same name already exists')
+                continue
+            origin = os.path.join(item, os.path.basename(path))
+            try:
+                os.rename(origin, path)
+            except OSError:
+                self.__errorData(path, 'Unable to restore')
+                continue
+            shutil.rmtree(item, True)
+            self.__changed(path, origin=origin)
+            self._response['select'].append(self.__hash(path))
+
+        if self._errorData:
+            self._response['error'] = 'Unable to restore files'
+        if 'current' in self._request:
+            curDir = self.__findDir(self._request['current'], None)
+            if curDir:
+                self.__content(curDir, True)
+
+    def __trashOrigin(self, rel):
+        """Path a trash item came from, None unless inside root"""
+        if '..' in rel.replace('\\', '/').split('/'):
+            return None
+        root = self._options['root']
+        trash = self._options['trash']
+        path = os.path.normpath(root + rel)
+        if not path.startswith(root + os.sep) or path == trash \
+                or path.startswith(trash + os.sep):
+            return None
+        return path
+
+    def __trashPurgeSchedule(self, now=False):
+        """Queue deletion of expired trash every 60s, or now"""
+        trashDir = self._options['trash']
+        if not trashDir:
+            return
+        with self._storeLock:
+            state = self._trashPurge.setdefault(trashDir, {})
+            if not now and self._time - state.get('last', 0) < 60:
+                return
+            if state.get('queued'):
+                return
+            state['last'] = self._time
+            state['queued'] = True
+            self.__pool('trash', 1).apply_async(
+                self.__trashPurgeRun,
+                (trashDir, self._options['trashRetention']))
+
+    def __trashPurgeRun(self, trashDir, retention):
+        """Delete trash items older than retention, return the errors"""
+        with self._storeLock:
+            self._trashPurge[trashDir]['queued'] = False
+        before = time.time() - retention
+        errors = []
+        for name in os.listdir(trashDir):
+            m = re.match(r'^(\d+)-', name)
+            if m and int(m.group(1)) <= before:
+                errors.extend(self.__purgeTree(os.path.join(trashDir, name)))
+        return errors
+
     def __remove(self, target):
         """Internal remove procedure"""
         if not self.__isAllowed(target, 'rm'):
             self.__errorData(target, 'Access denied')
 
         if not os.path.isdir(target):
+            self.__rmTmb(target)
             try:
                 os.unlink(target)
                 return True
@@ -957,29 +2403,186 @@ class connector():
 
         if not os.path.isdir(src):
             try:
-                shutil.copyfile(src, dst)
-                shutil.copymode(src, dst)
+                self.__copyFile(src, dst)
                 return True
             except:
                 self.__errorData(src, 'Unable to copy files')
                 return False
-        else:
+        return self.__copyTree(src, dst)
+
+    def __copyTree(self, src, dst, move=False):
+        """Copy directory src to new dst on the copy pool, batch by batch"""
+        workers = max(1, int(self._options['copyWorkers']))
+        pool = self.__pool('copy', workers)
+        pending = collections.deque()
+        failed = None
+        dirs = [(src, dst)]
+        created = []
+        while dirs and failed is None:
+            s, d = dirs.pop()
+            if not self.__isAllowed(s, 'read') \
+                    or not self.__isAllowed(os.path.dirname(d), 'write'):
+                failed = s
+                break
             try:
-                os.mkdir(dst)
-                shutil.copymode(src, dst)
-            except:
-                self.__errorData(src, 'Unable to copy files')
+                os.mkdir(d)
+                shutil.copymode(s, d)
+                names = os.listdir(s)
+            except OSError:
+                failed = s
+                break
+            if move:
+                created.append((s, d))
+            batch = []
+            for name in names:
+                ps, pd = os.path.join(s, name), os.path.join(d, name)
+                if os.path.isdir(ps) and not (move and os.path.islink(ps)):
+                    dirs.append((ps, pd))
+                    continue
+                batch.append((ps, pd))
+                if len(batch) == 256:
+                    pending.append(pool.apply_async(
+                        self.__copyFiles, (batch, move)))
+                    batch = []
+            if batch:
+                pending.append(pool.apply_async(
+                    self.__copyFiles, (batch, move)))
+            while len(pending) > workers * 4 and failed is None:
+                failed = pending.popleft().get()
+        for job in pending:
+            failed = job.get() or failed
+        if failed is not None:
+            self.__errorData(failed, 'Unable to copy files')
+            return False
+        for s, d in reversed(created):
+            shutil.copystat(s, d)
+        return True
+
+    def __moveAcross(self, src, dst):
+        """Move src to dst on another filesystem by copy and compare"""
+        copyDir = tempfile.mkdtemp(prefix='.move-', dir=os.path.dirname(dst))
+        oldDir = None
+        moved = False
+        try:
+            copy = os.path.join(copyDir, os.path.basename(dst))
+            if os.path.isdir(src) and not os.path.islink(src):
+                ok = self.__copyTree(src, copy, True)
+            else:
+                self.__copyFile(src, copy, True)
+                ok = True
+            if not ok or not self.__sameTree(src, copy):
                 return False
+            oldDir = tempfile.mkdtemp(prefix='.move-',
+                                      dir=os.path.dirname(src))
+            old = os.path.join(oldDir, os.path.basename(src))
+            os.rename(src, old)
+            try:
+                os.rename(copy, dst)
+            except OSError:
+                os.rename(old, src)
+                raise
+            moved = True
+        finally:
+            for error in self.__purgeTree(copyDir):
+                self.__debug('purgeFailed', error)
+            if oldDir is not None and not moved:
+                os.rmdir(oldDir)
+        for error in self.__purgeTree(oldDir):
+            self.__debug('purgeFailed', error)
+        return True
 
-            for i in os.listdir(src):
-                newSrc = os.path.join(src, i)
-                newDst = os.path.join(dst, i)
-                if not self.__copy(newSrc, newDst):
-                    self.__errorData(newSrc, 'Unable to copy files')
+    def __sameTree(self, src, dst):
+        """True if dst has the same names, file sizes and links as src"""
+        dirs = [(src, dst)]
+        while dirs:
+            s, d = dirs.pop()
+            try:
+                sst, dstat = os.lstat(s), os.lstat(d)
+                if stat.S_IFMT(sst.st_mode) != stat.S_IFMT(dstat.st_mode):
                     return False
-
+                if stat.S_ISLNK(sst.st_mode):
+                    if os.readlink(s) != os.readlink(d):
+                        return False
+                    continue
+                if not stat.S_ISDIR(sst.st_mode):
+                    if sst.st_size != dstat.st_size:
+                        return False
+                    continue
+                names = os.listdir(s)
+                if sorted(names) != sorted(os.listdir(d)):
+                    return False
+            except OSError:
+                return False
+            dirs.extend((os.path.join(s, n), os.path.join(d, n))
+                        for n in names)
         return True
 
+    def __purgeTree(self, path):
+        """Delete path and what it can below it, return the errors"""
+        if not os.path.lexists(path):
+            return []
+        if os.path.islink(path) or not os.path.isdir(path):
+            return self.__unlinkFiles([path])
+        workers = max(1, int(self._options['copyWorkers']))
+        pool = self.__pool('copy', workers)
+        pending = collections.deque()
+        dirs = []
+        errors = []
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            files = [os.path.join(dirpath, n) for n in filenames]
+            files.extend(os.path.join(dirpath, n) for n in dirnames
+                         if os.path.islink(os.path.join(dirpath, n)))
+            for i in range(0, len(files), 256):
+                pending.append(pool.apply_async(
+                    self.__unlinkFiles, (files[i:i + 256],)))
+                while len(pending) > workers * 4:
+                    errors.extend(pending.popleft().get())
+            dirs.append(dirpath)
+        for job in pending:
+            errors.extend(job.get())
+        # os.walk(topdown=False) lists children before their parents
+        for d in dirs:
+            try:
+                os.rmdir(d)
+            except OSError as e:
+                errors.append(str(e))
+        return errors
+
+    def __unlinkFiles(self, paths):
+        errors = []
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                errors.append(str(e))
+        return errors
+
+    def __copyFiles(self, pairs, move=False):
+        """Copy (src, dst) file pairs, return the first src that failed"""
+        for src, dst in pairs:
+            if not (move and os.path.islink(src)) \
+                    and not self.__isAllowed(src, 'read'):
+                return src
+            try:
+                self.__copyFile(src, dst, move)
+            except Exception:
+                return src
+        return None
+
+    def __copyFile(self, src, dst, move=False):
+        if move and os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+            size = 0
+        elif self.__dedupCopy(src, dst):
+            size = os.stat(dst).st_size
+        else:
+            size = _copyFile(src, dst)
+            if move:
+                shutil.copystat(src, dst)
+        with self._storeLock:
+            self._copied['files'] += 1
+            self._copied['bytes'] += size
+
     def __checkName(self, name):
         """Check for valid file/dir name"""
         pattern = r'[\/\\\:\<\>]'
@@ -990,28 +2593,187 @@ class connector():
     def __findDir(self, fhash, path):
         """Find directory by hash"""
         fhash = str(fhash)
+        if self._options['hashMode'] == 'path':
+            path = self.__unhash(fhash)
+            if path and os.path.isdir(path) and not os.path.islink(path):
+                return path
+            return None
+
         if not path:
             path = self._options['root']
             if fhash == self.__hash(path):
                 return path
+            found = self.__indexGet(fhash)
+            if found:
+                return found
 
         if not os.path.isdir(path):
             return None
 
-        for d in os.listdir(path):
+        for d in self.__cachedSubdirs(path):
             pd = os.path.join(path, d)
-            if os.path.isdir(pd) and not os.path.islink(pd):
-                if fhash == self.__hash(pd):
-                    return pd
-                else:
-                    ret = self.__findDir(fhash, pd)
-                    if ret:
-                        return ret
+            dhash = self.__indexAdd(pd)
+            if fhash == dhash:
+                return pd
+            else:
+                ret = self.__findDir(fhash, pd)
+                if ret:
+                    return ret
+        return None
+
+    def __indexGet(self, fhash):
+        """Resolve directory hash through the index, None if unknown/stale"""
+        index = self.__store('dirs')
+        rel = index.get(fhash)
+        if rel is None:
+            return None
+        path = self.__rootPath(rel)
+        if path and os.path.isdir(path) and not os.path.islink(path):
+            return path
+        with self._storeLock:
+            index.pop(fhash, None)
+            self.__storeDirty('dirs')
         return None
 
+    def __indexAdd(self, path, fhash=None):
+        """Record directory in the hash index, return its hash"""
+        if fhash is None:
+            fhash = self.__hash(path)
+        if self._options['hashMode'] == 'path':
+            return fhash
+        rel = path[len(self._options['root']):]
+        index = self.__store('dirs')
+        if index.get(fhash) != rel:
+            with self._storeLock:
+                index[fhash] = rel
+                self.__storeDirty('dirs')
+        return fhash
+
+    def __indexDrop(self, path):
+        """Forget directory and everything below it in the hash index"""
+        rel = path[len(self._options['root']):]
+        index = self.__store('dirs')
+        with self._storeLock:
+            for fhash in [h for h, r in index.items()
+                          if r == rel or r.startswith(rel + os.sep)]:
+                del index[fhash]
+                self.__storeDirty('dirs')
+
+    def __changed(self, path, gone=False, origin=None):
+        """Keep caches in sync after path was created, removed or moved"""
+        if origin is not None:
+            self.__remap(origin, path)
+            self.__changed(origin, True)
+        self._allowed.clear()
+        self._generationDirty = True
+        self.__sizeDrop(path, gone)
+        self.__treeDrop(path, gone)
+        if gone:
+            self.__indexDrop(path)
+        elif os.path.isdir(path) and not os.path.islink(path):
+            # subdirectories are indexed when __findDir() meets them
+            self.__indexAdd(path)
+
+    def __remap(self, old, new):
+        """Point the records below old at new after a move"""
+        root = self._options['root']
+        oldRel, newRel = old[len(root):], new[len(root):]
+
+        def moved(rel):
+            if rel == oldRel or rel.startswith(oldRel + os.sep):
+                return newRel + rel[len(oldRel):]
+            return None
+
+        with self._storeLock:
+            index = self.__store('dirs')
+            for fhash, rel in list(index.items()):
+                rel = moved(rel)
+                if rel is not None:
+                    del index[fhash]
+                    index[self.__hash(root + rel)] = rel
+                    self.__storeDirty('dirs')
+            dropped = []
+            for name in ('tmbsrc', 'imgdims'):
+                store = self.__store(name)
+                for key, rec in list(store.items()):
+                    if isinstance(rec, list):
+                        rel = moved(rec[1])
+                        if rel is None:
+                            continue
+                        if name == 'tmbsrc' and \
+                                not self._options['cacheDir']:
+                            dropped.append(store.pop(key)[0])
+                        else:
+                            rec[1] = rel
+                        self.__storeDirty(name)
+        for digest in dropped:
+            self.__tmbDrop(digest)
+
+    def __treeDrop(self, path, subtree=False):
+        """Invalidate cached tree nodes of path and its parent"""
+        cache = self._treeCache
+        cache.pop(path, None)
+        cache.pop(os.path.dirname(path), None)
+        if subtree:
+            for p in [p for p in list(cache) if p.startswith(path + os.sep)]:
+                cache.pop(p, None)
+
+    def __store(self, name):
+        """Process-wide dict `name`, loaded from cacheDir on first use"""
+        key = (self._options['root'], name)
+        with self._storeLock:
+            if key not in self._stores:
+                data = {}
+                if self._options['cacheDir']:
+                    fname = os.path.join(self._options['cacheDir'],
+                                         name + '.json')
+                    try:
+                        with open(fname) as f:
+                            data = json.load(f)
+                    except (IOError, OSError, ValueError):
+                        data = {}
+                self._stores[key] = data
+            return self._stores[key]
+
+    def __storeDirty(self, name):
+        """Mark store `name` for writing by __flushStores()"""
+        with self._storeLock:
+            self._storesDirty.add((self._options['root'], name))
+
+    def __flushStores(self):
+        """Write modified stores back to cacheDir in the background"""
+        root = self._options['root']
+        cacheDir = self._options['cacheDir']
+        with self._storeLock:
+            if not cacheDir:
+                self._storesDirty.difference_update(
+                    [k for k in self._storesDirty if k[0] == root])
+                return
+            if not self._storeDirs:
+                atexit.register(_flushStoresAtExit)
+            self._storeDirs[root] = cacheDir
+            now = time.time()
+            if now - self._storesFlushed.get(root, 0) < \
+                    self._options['cacheFlushInterval']:
+                return
+            self._storesFlushed[root] = now
+            keys = [k for k in self._storesDirty if k[0] == root]
+            self._storesDirty.difference_update(keys)
+            jobs = [(os.path.join(cacheDir, name + '.json'),
+                     dict(self._stores[(root, name)])) for root, name in keys]
+        if jobs:
+            self.__pool('stores', 1).apply_async(_writeStores, (jobs,))
+
     def __find(self, fhash, parent):
         """Find file/dir by hash"""
         fhash = str(fhash)
+        if self._options['hashMode'] == 'path':
+            path = self.__unhash(fhash)
+            if path and parent and os.path.dirname(path) == parent \
+                    and os.path.lexists(path):
+                return path
+            return None
+
         if os.path.isdir(parent):
             for i in os.listdir(parent):
                 path = os.path.join(parent, i)
@@ -1045,9 +2807,11 @@ class connector():
             if curFile and curDir:
                 if self.__isAllowed(curFile, 'write'):
                     try:
+                        self.__unshare(curFile)
                         f = open(curFile, 'w+')
                         f.write(self._request['content'])
                         f.close()
+                        self.__changed(curFile)
                         self._response['target'] = self.__info(curFile)
                     except:
                         self._response['error'] = 'Unable to write to file'
@@ -1100,22 +2864,35 @@ class connector():
         else:
             archiveName = realFiles[0]
         archiveName += '.' + arc['ext']
-        archiveName = self.__uniqueName(archiveName, '')
-        archivePath = os.path.join(curDir, archiveName)
+        archivePath = self.__uniqueName(os.path.join(curDir, archiveName), '')
+        archiveName = os.path.basename(archivePath)
 
-        cmd = [arc['cmd']]
-        for a in arc['argc'].split():
-            cmd.append(a)
-        cmd.append(archiveName)
-        for f in realFiles:
-            cmd.append(f)
-
-        curCwd = os.getcwd()
-        os.chdir(curDir)
-        self.__runSubProcess(cmd)
-        os.chdir(curCwd)
+        if 'builtin' in arc:
+            entries = self.__archiveEntries(
+                [os.path.join(curDir, f) for f in realFiles])
+            fd, tmp = tempfile.mkstemp(prefix='.archive-', dir=curDir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    _writeArchive(f, entries, arc['builtin'])
+                os.chmod(tmp, self._options['fileMode'])
+                _replace(tmp, archivePath)
+                tmp = None
+            except Exception as e:
+                self.__debug('archiveFailed', str(e))
+            finally:
+                if tmp is not None:
+                    os.unlink(tmp)
+        else:
+            cmd = [arc['cmd']]
+            for a in arc['argc'].split():
+                cmd.append(a)
+            cmd.append(archiveName)
+            for f in realFiles:
+                cmd.append(f)
+            self.__runSubProcess(cmd, cwd=curDir)
 
         if os.path.exists(archivePath):
+            self.__changed(archivePath)
             self.__content(curDir, False)
             self._response['select'] = [self.__hash(archivePath)]
         else:
@@ -1145,15 +2922,30 @@ class connector():
 
         arc = self._options['archivers']['extract'][mime]
 
-        cmd = [arc['cmd']]
-        for a in arc['argc'].split():
-            cmd.append(a)
-        cmd.append(os.path.basename(curFile))
-
-        curCwd = os.getcwd()
-        os.chdir(curDir)
-        ret = self.__runSubProcess(cmd)
-        os.chdir(curCwd)
+        before = set(os.listdir(curDir))
+        if 'builtin' in arc:
+            try:
+                names = _extractArchive(curFile, curDir, arc['builtin'])
+                ret = True
+            except Exception as e:
+                self.__debug('extractFailed', str(e))
+                names = []
+                ret = False
+        else:
+            cmd = [arc['cmd']]
+            for a in arc['argc'].split():
+                cmd.append(a)
+            cmd.append(os.path.basename(curFile))
+            ret = self.__runSubProcess(cmd, cwd=curDir)
+            # no telling which directories the command merged into
+            names = os.listdir(curDir)
+        for f in names:
+            path = os.path.join(curDir, f)
+            self.__changed(path)
+            if f in before and _isRealDir(path):
+                # merged into, cached sizes and tree nodes below are stale
+                self.__sizeDrop(path, True)
+                self.__treeDrop(path, True)
 
         if ret:
             self.__content(curDir, True)
@@ -1161,14 +2953,179 @@ class connector():
             self._response['error'] = 'Unable to extract files from archive'
         return
 
+    def __zipDownload(self):
+        """Stream targets as a zip archive straight into the response"""
+        curDir = None
+        if 'current' in self._request:
+            curDir = self.__findDir(self._request['current'], None)
+        files = self._request.get('targets[]')
+        if not curDir or not files or not _zipStreamable:
+            self._response['error'] = 'Invalid parameters'
+            return
+        if not self.__isAllowed(curDir, 'read'):
+            self._response['error'] = 'Access denied'
+            return
+        if not isinstance(files, list):
+            files = [files]
+
+        paths = []
+        for fhash in files:
+            curFile = self.__find(fhash, curDir)
+            if not curFile:
+                self._response['error'] = 'File not found'
+                return
+            paths.append(curFile)
+
+        if len(paths) > 1:
+            name = 'Archive.zip'
+        else:
+            name = os.path.basename(paths[0]) + '.zip'
+        self.httpStatusCode = 200
+        self.httpHeader['Content-type'] = 'application/zip'
+        self.httpHeader['Content-Disposition'] = 'attachment; filename=' + \
+            name
+        self.httpHeader['Content-Transfer-Encoding'] = 'binary'
+        self._response['file'] = streamResponse(
+            _zipStream(self.__archiveEntries(paths)))
+
+    def __archiveEntries(self, paths):
+        """(path, arcname) of paths and readable entries below, in root"""
+        entries = []
+        for path in paths:
+            if not self.__isAllowed(path, 'read') or not self.__inRoot(path):
+                continue
+            base = os.path.dirname(path)
+            entries.append((path, os.path.basename(path)))
+            if not os.path.isdir(path) or os.path.islink(path):
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(
+                    d for d in dirnames if self.__isAccepted(d) and
+                    self.__isAllowed(os.path.join(dirpath, d), 'read'))
+                for name in dirnames + sorted(filenames):
+                    pf = os.path.join(dirpath, name)
+                    if name in filenames and (
+                            not self.__isAccepted(name) or
+                            not self.__isAllowed(pf, 'read')):
+                        continue
+                    if not self.__inRoot(pf):
+                        continue
+                    entries.append((pf, pf[len(base) + 1:]))
+        return entries
+
+    def __inRoot(self, path):
+        """False if path is a symlink that resolves outside root"""
+        if not os.path.islink(path):
+            return True
+        root = os.path.realpath(self._options['root'])
+        real = os.path.realpath(path)
+        return real == root or real.startswith(root + os.sep)
+
     def __ping(self):
         """Workaround for Safari"""
         self.httpStatusCode = 200
         self.httpHeader['Connection'] = 'close'
         return
 
-    def __mimetype(self, path):
+    def __mimetype(self, path, st=None):
         """Detect mimetype of file"""
+        cache = self._mimeCache
+        mime = self.__cacheGet(cache, path)
+        if mime is None:
+            name = os.path.basename(path)
+            dot = name.rfind('.')
+            if dot == -1:
+                mime = self.__guessMimetype(os.sep + name)
+            else:
+                ext = name[dot:]
+                lext = ext.lower()
+                if lext in mimetypes.encodings_map \
+                        or lext in mimetypes.suffix_map:
+                    # compound extension, e.g. .tar.gz
+                    prev = name.rfind('.', 0, dot)
+                    ext = name[dot if prev == -1 else prev:]
+                table = self.__mimeTable()
+                mime = table.get(ext)
+                if mime is None:
+                    mime = self.__guessMimetype('x' + ext)
+                    if len(table) < 4096:
+                        table[ext] = mime
+            with self._storeLock:
+                cache[path] = mime
+                while len(cache) > self._options['mimeCacheSize']:
+                    cache.popitem(last=False)
+
+        if mime == 'unknown' and self._options['mimeSniff']:
+            mime = self.__sniffMimetype(path, st)
+        return mime
+
+    def __cacheGet(self, cache, key):
+        """Value of key in LRU cache, moved to the most recently used end"""
+        with self._storeLock:
+            value = cache.pop(key, None)
+            if value is not None:
+                cache[key] = value
+            return value
+
+    def __mimeTable(self):
+        """Extension -> mimetype table, built on first use"""
+        if connector._mimeTable is None:
+            table = {}
+            exts = list(mimetypes.types_map.keys())
+            exts += ['.' + ext for ext in self._mimeType]
+            for ext in exts:
+                table[ext] = self.__guessMimetype('x' + ext)
+            connector._mimeTable = table
+        return connector._mimeTable
+
+    def __sniffMimetype(self, path, st=None):
+        """Mimetype from the first bytes of the file, cached by stat"""
+        try:
+            if st is None:
+                st = os.stat(path)
+        except OSError:
+            return 'unknown'
+        if not stat.S_ISREG(st.st_mode) or not st.st_size:
+            return 'unknown'
+
+        key = self.__statKey(st)
+        cache = self._sniffCache
+        mime = self.__cacheGet(cache, key)
+        if mime is not None:
+            return mime
+
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(512)
+        except (IOError, OSError):
+            return 'unknown'
+
+        mime = 'unknown'
+        for offset, magic, magicMime in self._mimeMagic:
+            if head[offset:offset + len(magic)] == magic:
+                mime = magicMime
+                break
+        else:
+            if b'\0' not in head:
+                try:
+                    head.decode('utf-8')
+                    mime = 'text/plain'
+                except UnicodeDecodeError:
+                    # may be cut in the middle of a multibyte char
+                    try:
+                        head[:-3].decode('utf-8')
+                        mime = 'text/plain'
+                    except UnicodeDecodeError:
+                        pass
+
+        with self._storeLock:
+            cache[key] = mime
+            while len(cache) > self._options['mimeCacheSize']:
+                cache.popitem(last=False)
+        return mime
+
+    def __guessMimetype(self, path):
+        """Mimetype by file name"""
         mime = mimetypes.guess_type(path)[0] or 'unknown'
         ext = path[path.rfind('.') + 1:]
 
@@ -1191,48 +3148,222 @@ class connector():
         # self.__debug('mime ' + os.path.basename(path), ext + ' ' + mime)
         return mime
 
-    def __tmb(self, path, tmb):
-        """Internal thumbnail create procedure"""
-        try:
-            im = self._im.open(path).copy()
-            size = self._options['tmbSize'], self._options['tmbSize']
-            box = self.__cropTuple(im.size)
-            if box:
-                im = im.crop(box)
-            im.thumbnail(size, self._im.ANTIALIAS)
-            im.save(tmb, 'PNG')
-        except Exception as e:
-            self.__debug('tmbFailed_' + path, str(e))
+    def __tmb(self, path, key):
+        """Internal thumbnail create procedure, returns content digest"""
+        digest, error = _createThumbnails(path, self._options['tmbDir'],
+                                          self.__tmbSizes(),
+                                          self._options['tmbFormat'],
+                                          self._options['tmbQuality'],
+                                          self.__tmbPathDigest(path))
+        return self.__tmbDone(path, key, digest, error)
+
+    def __tmbDone(self, path, key, digest, error):
+        """Record digest of thumbnail source identified by stat key"""
+        if error:
+            self.__debug('tmbFailed_' + path, error)
             return False
-        return True
+        with self._storeLock:
+            self.__store('tmbsrc')[key] = [
+                digest, path[len(self._options['root']):]]
+            self.__storeDirty('tmbsrc')
+            manifest = self.__tmbManifest()
+            for size in self.__tmbSizes():
+                name = os.path.basename(self.__tmbFile(digest, size))
+                try:
+                    st = os.stat(os.path.join(self._options['tmbDir'], name))
+                except OSError:
+                    continue
+                entry = manifest.get(name)
+                if entry is None or entry[2:] != [st.st_mtime]:
+                    # new, or a path named thumbnail written again
+                    manifest[name] = [st.st_size, st.st_mtime, st.st_mtime]
+                    self.__storeDirty('tmbmanifest')
+        return digest
 
     def __rmTmb(self, path):
-        tmb = self.__tmbPath(path)
-        if self._options['tmbDir']:
-            if os.path.exists(tmb):
+        """Forget thumbnail source path, delete thumbnails nobody shares"""
+        if not self.__canCreateTmb(path):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        digest = self.__tmbPathDigest(path)
+        if st.st_nlink > 1 and digest is None:
+            return
+
+        sources = self.__store('tmbsrc')
+        with self._storeLock:
+            rec = sources.pop(self.__statKey(st), None)
+            if rec is not None:
+                self.__storeDirty('tmbsrc')
+        if digest is None:
+            if rec is None:
+                return
+            digest = rec[0]
+        self.__tmbDrop(digest)
+
+    def __tmbDrop(self, digest):
+        """Delete the thumbnails of digest unless a source still has it"""
+        with self._storeLock:
+            if any(r[0] == digest for r in self.__store('tmbsrc').values()):
+                return
+        for size in self.__tmbSizes():
+            self.__tmbUnlink(os.path.basename(self.__tmbFile(digest, size)))
+
+    def __tmbUnlink(self, name):
+        """Delete thumbnail file name from tmbDir and the manifest"""
+        with self._storeLock:
+            self.__tmbManifest().pop(name, None)
+            self.__storeDirty('tmbmanifest')
+        try:
+            os.unlink(os.path.join(self._options['tmbDir'], name))
+        except OSError:
+            pass
+
+    def __tmbDigest(self, path, key):
+        """Thumbnail set name of path with stat key, None if unknown"""
+        digest = self.__tmbPathDigest(path)
+        if digest is None:
+            rec = self.__store('tmbsrc').get(key)
+            digest = rec[0] if rec else None
+        return digest
+
+    def __tmbPathDigest(self, path):
+        """Thumbnail set name from path without cacheDir, else None"""
+        if self._options['cacheDir']:
+            return None
+        rel = path[len(self._options['root']):]
+        return hashlib.md5(rel.encode('utf-8')).hexdigest()
+
+    def __tmbSweepSchedule(self):
+        """Queue the next thumbnail GC round every tmbSweepInterval"""
+        if not self._options['tmbDir'] or not self._options['imgLib']:
+            return
+        root = self._options['root']
+        with self._storeLock:
+            state = self._sweepState.setdefault(
+                root, {'last': 0, 'job': None, 'src': [], 'dims': [],
+                       'legacy': True})
+            if self._time - state['last'] < \
+                    self._options['tmbSweepInterval']:
+                return
+            if state['job'] is not None and not state['job'].ready():
+                return
+            state['last'] = self._time
+            state['job'] = self.__pool('tmbgc', 1).apply_async(
+                self.__tmbSweep, (state,))
+
+    def __tmbSweep(self, state):
+        """One incremental thumbnail GC round, runs in the background"""
+        with self._storeLock:
+            legacy, state['legacy'] = state['legacy'], False
+        if legacy:
+            self.__tmbLegacyPurge()
+        batch = self._options['tmbSweepBatch']
+        for rec in self.__sweepRecords('tmbsrc', state, 'src', batch):
+            self.__tmbDrop(rec[0])
+        self.__sweepRecords('imgdims', state, 'dims', batch)
+        self.__tmbEvict()
+
+    def __sweepRecords(self, name, state, part, batch):
+        """Drop a batch of records of store name whose file changed"""
+        root = self._options['root']
+        store = self.__store(name)
+        with self._storeLock:
+            if not state[part]:
+                state[part] = list(store)
+            keys, state[part] = state[part][:batch], state[part][batch:]
+        gone = []
+        for key in keys:
+            rec = store.get(key)
+            if rec is None:
+                continue
+            try:
+                valid = isinstance(rec, list) and \
+                    self.__statKey(os.stat(root + rec[1])) == key
+            except OSError as e:
+                valid = False
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    gone.append(rec)
+            if not valid:
+                with self._storeLock:
+                    store.pop(key, None)
+                    self.__storeDirty(name)
+        return gone
+
+    def __tmbLegacyPurge(self):
+        """Delete the unused <md5 of path>.png thumbnails"""
+        manifest = self.__store('tmbmanifest')
+        for name, path, st, tst in self.__scandir(self._options['tmbDir']):
+            if _tmbLegacy.match(name) and stat.S_ISREG(st.st_mode):
+                with self._storeLock:
+                    if manifest.pop(name, None) is not None:
+                        self.__storeDirty('tmbmanifest')
                 try:
-                    os.unlink(tmb)
-                except:
+                    os.unlink(path)
+                except OSError:
                     pass
 
-    def __cropTuple(self, size):
-        w, h = size
-        if w > h:  # landscape
-            l = int((w - h) / 2)
-            u = 0
-            r = l + h
-            d = h
-            return (l, u, r, d)
-        elif h > w:  # portrait
-            l = 0
-            u = int((h - w) / 2)
-            r = w
-            d = u + w
-            return (l, u, r, d)
-        else:  # cube
-            pass
+    def __tmbEvict(self):
+        """Drop least recently used thumbnails beyond the tmbMax limits"""
+        maxBytes = self._options['tmbMaxBytes']
+        maxCount = self._options['tmbMaxCount']
+        if not maxBytes and not maxCount:
+            return
+        with self._storeLock:
+            items = list(self.__tmbManifest().items())
+        total = sum(entry[0] for name, entry in items)
+        count = len(items)
+        if (not maxBytes or total <= maxBytes) \
+                and (not maxCount or count <= maxCount):
+            return
 
-        return False
+        items.sort(key=lambda item: item[1][1])
+        for name, entry in items:
+            if (not maxBytes or total <= maxBytes * 0.9) \
+                    and (not maxCount or count <= maxCount * 0.9):
+                break
+            self.__tmbUnlink(name)
+            total -= entry[0]
+            count -= 1
+
+    def __tmbManifest(self):
+        """Thumbnails in tmbDir, name -> [bytes, use time, mtime]"""
+        manifest = self.__store('tmbmanifest')
+        root = self._options['root']
+        if root not in self._manifestBuilt:
+            with self._storeLock:
+                if not manifest:
+                    for name, path, st, tst in self.__scandir(
+                            self._options['tmbDir']):
+                        if stat.S_ISREG(st.st_mode) \
+                                and not name.endswith('.tmp'):
+                            manifest[name] = [st.st_size, st.st_mtime,
+                                              st.st_mtime]
+                    self.__storeDirty('tmbmanifest')
+                self._manifestBuilt.add(root)
+        return manifest
+
+    def __tmbExists(self, digest, st, touch=False):
+        """Whether the manifest has every size of digest newer than st"""
+        manifest = self.__tmbManifest()
+        entries = [manifest.get(os.path.basename(self.__tmbFile(digest, size)))
+                   for size in self.__tmbSizes()]
+        if None in entries:
+            return False
+        if not self._options['cacheDir'] and any(
+                entry[-1] < st.st_mtime for entry in entries):
+            # path named, made before the source last changed
+            return False
+        if touch:
+            interval = self._options['tmbSweepInterval']
+            with self._storeLock:
+                for entry in entries:
+                    if self._time - entry[1] >= interval:
+                        entry[1] = self._time
+                        self.__storeDirty('tmbmanifest')
+        return True
 
     def __readlink(self, path):
         """Read link and return real path if not broken"""
@@ -1248,15 +3379,83 @@ class connector():
     def __dirSize(self, path):
         total_size = 0
         if self._options['dirSize']:
-            for dirpath, dirnames, filenames in os.walk(path):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    if os.path.exists(fp):
-                        total_size += os.stat(fp).st_size
+            total_size = self.__aggregateSize(
+                path, self._options['dirSizeDefer'])
         else:
             total_size = os.lstat(path).st_size
         return total_size
 
+    def __aggregateSize(self, path, cachedOnly=False, refresh=False):
+        """Size of all files below path, walking only changed directories"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 0
+
+        store = self.__store('dirsize')
+        rel = path[len(self._options['root']):]
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        now = time.time()
+        ttl = self._options['dirSizeTTL']
+        rec = store.get(rel)
+        if rec and rec[0] == st.st_ino and rec[1] == mtime:
+            if not ttl or now - rec[3] < ttl:
+                return rec[2]
+            if not refresh:
+                self.__sizeRefreshSchedule(path)
+                return rec[2]
+        if cachedOnly:
+            return None
+
+        total = 0
+        try:
+            entries = self.__scandir(path)
+        except OSError:
+            entries = []
+        for name, pf, lst, tst in entries:
+            if stat.S_ISDIR(lst.st_mode):
+                total += self.__aggregateSize(pf, refresh=refresh)
+            elif tst is not None and not stat.S_ISDIR(tst.st_mode):
+                total += tst.st_size
+
+        with self._storeLock:
+            store[rel] = [st.st_ino, mtime, total, now]
+            self.__storeDirty('dirsize')
+        return total
+
+    def __sizeRefreshSchedule(self, path):
+        """Re-walk path's expired size records on the dirsize pool"""
+        with self._storeLock:
+            if path in self._sizeRefresh:
+                return
+            self._sizeRefresh.add(path)
+        pool = self.__pool('dirsize', self._options['dirSizeWorkers'])
+        pool.apply_async(self.__sizeRefreshRun, (path,))
+
+    def __sizeRefreshRun(self, path):
+        try:
+            self.__aggregateSize(path, refresh=True)
+        finally:
+            with self._storeLock:
+                self._sizeRefresh.discard(path)
+
+    def __sizeDrop(self, path, subtree=False):
+        """Invalidate aggregated sizes of path's ancestors (and subtree)"""
+        root = self._options['root']
+        rel = path[len(root):]
+        store = self.__store('dirsize')
+        with self._storeLock:
+            if subtree:
+                for r in [r for r in store
+                          if r == rel or r.startswith(rel + os.sep)]:
+                    del store[r]
+            while rel:
+                rel = os.path.dirname(rel)
+                if rel == os.sep:
+                    rel = ''
+                store.pop(rel, None)
+            self.__storeDirty('dirsize')
+
     def __fbuffer(self, f, chunk_size=_options['uploadWriteChunk']):
         while True:
             chunk = f.read(chunk_size)
@@ -1274,13 +3473,16 @@ class connector():
         else:
             return False
 
-    def __tmbPath(self, path):
-        tmb = False
-        if self._options['tmbDir']:
-            if not os.path.dirname(path) == self._options['tmbDir']:
-                tmb = os.path.join(self._options['tmbDir'],
-                                   self.__hash(path) + '.png')
-        return tmb
+    def __tmbFile(self, digest, size=None):
+        """Thumbnail of content digest at size (tmbSize by default)"""
+        return os.path.join(self._options['tmbDir'], _tmbName(
+            digest, size or self._options['tmbSize'],
+            self._options['tmbFormat']))
+
+    def __tmbSizes(self):
+        sizes = set(self._options['tmbSizes'].values())
+        sizes.add(self._options['tmbSize'])
+        return sorted(sizes)
 
     def __isUploadAllow(self, name):
         allow = False
@@ -1323,8 +3525,15 @@ class connector():
             return False
         return True
 
-    def __isAllowed(self, path, access):
-        if not os.path.exists(path):
+    def __isAllowed(self, path, access, st=None):
+        """Check access, st is the (followed) stat of path if known"""
+        key = (path, access)
+        if key not in self._allowed:
+            self._allowed[key] = self.__checkAllowed(path, access, st)
+        return self._allowed[key]
+
+    def __checkAllowed(self, path, access, st):
+        if st is None and not os.path.exists(path):
             return False
 
         if access == 'read':
@@ -1336,27 +3545,108 @@ class connector():
                 self.__errorData(path, access)
                 return False
         elif access == 'rm':
-            if not os.access(os.path.dirname(path), os.W_OK):
+            parent = os.path.dirname(path)
+            if parent not in self._dirWritable:
+                self._dirWritable[parent] = os.access(parent, os.W_OK)
+            if not self._dirWritable[parent]:
                 self.__errorData(path, access)
                 return False
         else:
             return False
 
         path = path[len(os.path.normpath(self._options['root'])):]
-        for ppath in self._options['perms']:
-            regex = r'' + ppath
-            if re.search(regex, path)\
-                    and access in self._options['perms'][ppath]:
-                return self._options['perms'][ppath][access]
+        rules = self._perms.get(access)
+        if rules is not None:
+            if isinstance(rules, list):
+                for regex, allowed in rules:
+                    if regex.search(path):
+                        return allowed
+            else:
+                m = rules[0].search(path)
+                if m:
+                    return rules[1][m.lastgroup]
 
         return self._options['defaults'][access]
 
+    def __compilePerms(self):
+        """Compile perms into one first-match matcher per access type"""
+        perms = {}
+        for access in ('read', 'write', 'rm'):
+            rules = [(ppath, self._options['perms'][ppath][access])
+                     for ppath in self._options['perms']
+                     if access in self._options['perms'][ppath]]
+            if not rules:
+                continue
+            alternatives = []
+            values = {}
+            for i, (ppath, allowed) in enumerate(rules):
+                alternatives.append(
+                    r'(?=[\s\S]*?(?:%s))(?P<_p%d>)' % (ppath, i))
+                values['_p%d' % i] = allowed
+            try:
+                if any(re.search(r'\\[1-9]|\(\?P=|\(\?[-aiLmsux]', ppath)
+                       for ppath, allowed in rules):
+                    raise re.error('backreference or inline flags')
+                combined = re.compile(r'^(?:' + '|'.join(alternatives) + ')')
+                perms[access] = (combined, values)
+            except re.error:
+                perms[access] = [(re.compile(r'' + ppath), allowed)
+                                 for ppath, allowed in rules]
+        return perms
+
     def __hash(self, path):
         """Hash of the path"""
+        if self._options['hashMode'] == 'path':
+            rel = path[len(self._options['root']):].encode('utf-8')
+            payload = base64.urlsafe_b64encode(rel).rstrip(b'=')
+            return self.__hashMac(payload) + payload.decode('ascii')
+
         m = hashlib.md5()
         m.update(path.encode('utf-8'))
         return str(m.hexdigest())
 
+    def __hashMac(self, payload):
+        """Signature prefix for reversible hashes"""
+        secret = self._options['hashSecret']
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        return hmac.new(secret, payload, hashlib.sha256).hexdigest()[:16]
+
+    def __unhash(self, fhash):
+        """Decode reversible hash into path, None if forged or outside root"""
+        try:
+            payload = fhash[16:].encode('ascii')
+            mac = fhash[:16].encode('ascii')
+        except UnicodeError:
+            # compare_digest() raises on non-ASCII str
+            return None
+        expected = self.__hashMac(payload).encode('ascii')
+        if hasattr(hmac, 'compare_digest'):
+            valid = hmac.compare_digest(mac, expected)
+        else:
+            valid = mac == expected
+        if not valid:
+            return None
+
+        try:
+            payload += b'=' * (-len(payload) % 4)
+            rel = base64.urlsafe_b64decode(payload).decode('utf-8')
+        except Exception:
+            return None
+
+        return self.__rootPath(rel)
+
+    def __rootPath(self, rel):
+        """root + rel normalized, None if that is not inside root"""
+        root = self._options['root']
+        try:
+            path = os.path.normpath(root + rel)
+        except TypeError:
+            return None
+        if path != root and not path.startswith(root + os.sep):
+            return None
+        return path
+
     def __path2url(self, path):
         curDir = path
         length = len(self._options['root'])
@@ -1387,16 +3677,55 @@ class connector():
         self.__debug('imgLib', self._options['imgLib'])
         return self._options['imgLib']
 
-    def __getImgSize(self, path):
+    def __getImgSize(self, path, st=None):
+        """Image dimensions through the 'imgdims' store, None if pending"""
         self.__initImgLib()
-        if self.__canCreateTmb():
-            try:
-                im = self._im.open(path)
-                return str(im.size[0]) + 'x' + str(im.size[1])
-            except:
-                pass
+        if not self.__canCreateTmb():
+            return False
+        try:
+            if st is None:
+                st = os.stat(path)
+        except OSError:
+            return False
 
-        return False
+        key = self.__statKey(st)
+        rec = self.__store('imgdims').get(key)
+        if isinstance(rec, list):
+            return rec[0] or False
+
+        if self._options['imgDimsBackground']:
+            with self._storeLock:
+                if key not in self._dimJobs:
+                    self._dimJobs.add(key)
+                    self.__pool('imgdims', 1).apply_async(
+                        self.__readImgSize, (path, key))
+            self._partial = True
+            return None
+
+        return self.__readImgSize(path, key)
+
+    def __readImgSize(self, path, key):
+        dim = ''
+        try:
+            im = self._im.open(path)
+            dim = str(im.size[0]) + 'x' + str(im.size[1])
+            if hasattr(im, 'close'):
+                im.close()
+        except Exception:
+            pass
+
+        with self._storeLock:
+            self.__store('imgdims')[key] = [
+                dim, path[len(self._options['root']):]]
+            self.__storeDirty('imgdims')
+            self._dimJobs.discard(key)
+        return dim or False
+
+    def __statKey(self, st):
+        """Identity of file content as far as stat can tell"""
+        return '%d:%d:%s:%d' % (st.st_dev, st.st_ino,
+                                getattr(st, 'st_mtime_ns', st.st_mtime),
+                                st.st_size)
 
     def __debug(self, k, v):
         if self._options['debug']:
@@ -1417,16 +3746,17 @@ class connector():
             self._options['archivers'] = archive
             return
 
-        tar = self.__runSubProcess(['tar', '--version'])
-        gzip = self.__runSubProcess(['gzip', '--version'])
-        bzip2 = self.__runSubProcess(['bzip2', '--version'])
-        zipc = self.__runSubProcess(['zip', '--version'])
-        unzip = self.__runSubProcess(['unzip', '--help'])
-        rar = self.__runSubProcess(['rar', '--version'], validReturn=[0, 7])
-        unrar = self.__runSubProcess(['unrar'], validReturn=[0, 7])
-        p7z = self.__runSubProcess(['7z', '--help'])
-        p7za = self.__runSubProcess(['7za', '--help'])
-        p7zr = self.__runSubProcess(['7zr', '--help'])
+        tools = self.__archiverTools()
+        tar = tools.get('tar')
+        gzip = tools.get('gzip')
+        bzip2 = tools.get('bzip2')
+        zipc = tools.get('zip')
+        unzip = tools.get('unzip')
+        rar = tools.get('rar')
+        unrar = tools.get('unrar')
+        p7z = tools.get('7z')
+        p7za = tools.get('7za')
+        p7zr = tools.get('7zr')
 
         # tar = False
         # tar = gzip = bzip2 = zipc = unzip = rar = unrar = False
@@ -1512,6 +3842,11 @@ class connector():
             if mime not in e:
                 e.update({mime: {'cmd': p7zip, 'argc': 'e -y', 'ext': 'zip'}})
 
+        if self._options['archiveBuiltin']:
+            create, extract = _builtinArchivers()
+            c.update(create)
+            e.update(extract)
+
         if not self._options['archiveMimes']:
             self._options['archiveMimes'] = list(c.keys())
         else:
@@ -1520,14 +3855,57 @@ class connector():
         self._options['archivers'] = archive
         pass
 
-    def __runSubProcess(self, cmd, validReturn=[0]):
+    def refreshArchivers(self):
+        """Probe the archiver commands again, return {command: found}"""
+        tools = {
+            'tar': self.__runSubProcess(['tar', '--version']),
+            'gzip': self.__runSubProcess(['gzip', '--version']),
+            'bzip2': self.__runSubProcess(['bzip2', '--version']),
+            'zip': self.__runSubProcess(['zip', '--version']),
+            'unzip': self.__runSubProcess(['unzip', '--help']),
+            'rar': self.__runSubProcess(['rar', '--version'],
+                                        validReturn=[0, 7]),
+            'unrar': self.__runSubProcess(['unrar'], validReturn=[0, 7]),
+            '7z': self.__runSubProcess(['7z', '--help']),
+            '7za': self.__runSubProcess(['7za', '--help']),
+            '7zr': self.__runSubProcess(['7zr', '--help'])
+        }
+        with self._storeLock:
+            connector._archiverTools = tools
+        if self._options['cacheDir']:
+            fname = os.path.join(self._options['cacheDir'], 'archivers.json')
+            for fname, error in _writeStores([(fname, tools)]):
+                self.__debug('storeFailed_archivers', error)
+        return tools
+
+    def __archiverTools(self):
+        """Archiver commands found on this host, probed once per process"""
+        with self._storeLock:
+            tools = connector._archiverTools
+        if tools is not None:
+            return tools
+        if self._options['cacheDir']:
+            try:
+                with open(os.path.join(self._options['cacheDir'],
+                                       'archivers.json')) as f:
+                    tools = json.load(f)
+            except (IOError, OSError, ValueError):
+                tools = None
+            if isinstance(tools, dict):
+                with self._storeLock:
+                    connector._archiverTools = tools
+                return tools
+        return self.refreshArchivers()
+
+    def __runSubProcess(self, cmd, validReturn=[0], cwd=None):
         if self._sp is None:
             import subprocess
             self._sp = subprocess
 
         try:
             sp = self._sp.Popen(cmd, shell=False, stdout=self._sp.PIPE,
-                                stderr=self._sp.PIPE, stdin=self._sp.PIPE)
+                                stderr=self._sp.PIPE, stdin=self._sp.PIPE,
+                                cwd=cwd)
             out, err = sp.communicate('')
             ret = sp.returncode
             # print cmd, ret, out, err
@@ -1555,3 +3933,19 @@ class connector():
             self.__debug('invalid encoding', name)
             #  name += ' (invalid encoding)'
         return name
+
+
+def _flushStoresAtExit():
+    """Wait for background store writes, then write what is still dirty"""
+    with connector._storeLock:
+        pool = connector._pools.pop('stores', None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    with connector._storeLock:
+        jobs = [(os.path.join(connector._storeDirs[root], name + '.json'),
+                 connector._stores[(root, name)])
+                for root, name in connector._storesDirty
+                if root in connector._storeDirs]
+        connector._storesDirty.clear()
+    _writeStores(jobs)
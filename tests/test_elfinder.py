@@ -0,0 +1,1232 @@
+import io
+import os
+import re
+import json
+import errno
+import base64
+import sys
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import elfinder  # noqa: E402
+
+
+class ConnectorTestCase(unittest.TestCase):
+    """Connector on an empty temporary root, options put back after"""
+
+    options = {}
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='elfinder-test-')
+        self.addCleanup(shutil.rmtree, self.root, True)
+        saved = dict(elfinder.connector._options)
+        self.addCleanup(elfinder.connector._options.update, saved)
+        opts = {'root': self.root, 'URL': 'http://localhost/files',
+                'perms': {}, 'hashMode': 'md5', 'hashSecret': '',
+                'tmbDir': '.tmb', 'cacheDir': False, 'listingETag': False,
+                'trash': False, 'uploadChunkDir': False}
+        opts.update(self.options)
+        self.connector = elfinder.connector(opts)
+        self.private('reset')()
+
+    def private(self, name):
+        return getattr(self.connector, '_connector__' + name)
+
+    def request(self, **request):
+        """connector.run() with request, return the response"""
+        status, header, response = self.connector.run(request)
+        return response
+
+    def hash(self, rel=''):
+        return self.private('hash')(self.root + rel)
+
+
+class DirIndexTestCase(ConnectorTestCase):
+    """Directory hashes resolve through the persisted index"""
+
+    options = {'cacheDir': '.cache', 'cacheFlushInterval': 0,
+               'dirSize': False}
+
+    def setUp(self):
+        super(DirIndexTestCase, self).setUp()
+        os.makedirs(self.root + '/a/b/c')
+
+    def open(self, rel):
+        return self.request(cmd='open', target=self.hash(rel))
+
+    def noWalk(self):
+        def walk(path, st=None):
+            raise AssertionError('walked %s' % path)
+        self.connector._connector__cachedSubdirs = walk
+        self.addCleanup(delattr, self.connector, '_connector__cachedSubdirs')
+
+    def test_walk_once(self):
+        self.assertEqual(self.open('/a/b/c')['cwd']['name'], 'c')
+        self.noWalk()
+        self.assertEqual(self.open('/a/b/c')['cwd']['name'], 'c')
+
+    def test_persisted(self):
+        self.open('/a/b/c')
+        self.private('pool')('stores', 1).apply_async(len, ('',)).get()
+        with open(os.path.join(self.root, '.cache', 'dirs.json')) as f:
+            self.assertEqual(json.load(f)[self.hash('/a/b/c')],
+                             os.path.join('/a', 'b', 'c'))
+        # a new process loads the index instead of walking
+        del self.connector._stores[(self.root, 'dirs')]
+        self.noWalk()
+        self.assertEqual(self.open('/a/b/c')['cwd']['name'], 'c')
+
+    def test_rename(self):
+        old = self.hash('/a/b/c')
+        self.open('/a/b/c')
+        response = self.request(cmd='rename', current=self.hash('/a'),
+                                target=self.hash('/a/b'), name='x')
+        self.assertNotIn('error', response)
+        self.assertEqual(self.request(cmd='open', target=old)['error'],
+                         'Invalid parameters')
+        self.noWalk()
+        self.assertEqual(self.open('/a/x/c')['cwd']['name'], 'c')
+
+
+class DirSizeTestCase(ConnectorTestCase):
+    """Directory sizes computed by the dirsize command"""
+
+    options = {'dirSize': True, 'dirSizeDefer': True, 'dirSizeTTL': 3600,
+               'dirSizeTime': 5}
+
+    def write(self, rel, size):
+        with open(self.root + rel, 'wb') as f:
+            f.write(b'x' * size)
+
+    def dirsize(self, wait=5):
+        self.connector._options['dirSizeTime'] = wait
+        return self.request(cmd='dirsize', current=self.hash())
+
+    def sizes(self, rel=''):
+        response = self.request(cmd='open', target=self.hash(rel))
+        return dict((f['name'], f['size']) for f in response['cdc']
+                    if f['mime'] == 'directory')
+
+    def test_listing_walks_changed_dirs_only(self):
+        self.connector._options['dirSizeDefer'] = False
+        os.makedirs(self.root + '/d/e')
+        os.mkdir(self.root + '/f')
+        self.write('/d/a', 10)
+        self.write('/d/e/b', 100)
+        self.assertEqual(self.sizes(), {'d': 110, 'f': 0})
+
+        listed = []
+        scandir = self.private('scandir')
+
+        def counting(path):
+            if path != self.connector._options['tmbDir']:  # thumbnail sweep
+                listed.append(path[len(self.root):])
+            return scandir(path)
+        self.connector._connector__scandir = counting
+        self.addCleanup(delattr, self.connector, '_connector__scandir')
+        self.assertEqual(self.sizes(), {'d': 110, 'f': 0})
+        self.assertEqual(listed, [''])
+
+        del listed[:]
+        response = self.request(cmd='upload', current=self.hash('/d/e'), **{
+            'upload[]': {'c': io.BytesIO(b'x' * 1000)}})
+        self.assertNotIn('error', response)
+        del listed[:]
+        self.assertEqual(self.sizes(), {'d': 1110, 'f': 0})
+        self.assertEqual(sorted(listed), ['', '/d', '/d/e'])
+
+    def test_growth_between_requests(self):
+        os.mkdir(self.root + '/d')
+        self.write('/d/a', 10)
+        fhash = self.hash('/d')
+        # keep the workers busy, so the job finishes after the response
+        pool = self.private('pool')('dirsize', 4)
+        release = threading.Event()
+        for i in range(pool._processes):
+            pool.apply_async(release.wait)
+        response = self.dirsize(0)
+        self.assertTrue(response['dirsize'])
+        self.assertNotIn(fhash, response['sizes'])
+        release.set()
+        key, job = self.connector._sizeJobs[self.root + '/d']
+        job.wait()
+        self.write('/d/b', 1000)
+        self.assertEqual(self.dirsize()['sizes'][fhash], 1010)
+        self.assertNotIn(self.root + '/d', self.connector._sizeJobs)
+
+    def test_listing_defers_to_dirsize(self):
+        os.mkdir(self.root + '/d')
+        self.write('/d/a', 10)
+        response = self.request(cmd='open', target=self.hash())
+        d, = [f for f in response['cdc'] if f['name'] == 'd']
+        self.assertTrue(d.get('sizePending'))
+        self.assertEqual(self.dirsize()['sizes'], {self.hash('/d'): 10})
+        response = self.request(cmd='open', target=self.hash())
+        d, = [f for f in response['cdc'] if f['name'] == 'd']
+        self.assertEqual(d['size'], 10)
+        self.assertNotIn('sizePending', d)
+
+
+class TreeCacheTestCase(ConnectorTestCase):
+    """Tree nodes are cached across requests until a directory changes"""
+
+    options = {'treeDepth': 0, 'rootAlias': 'Home'}
+
+    def tree(self):
+        self.private('reset')()
+        return self.private('tree')(self.root)
+
+    def test_no_access_checks_when_unchanged(self):
+        for rel in ('/a/b', '/a/c', '/d'):
+            os.makedirs(self.root + rel)
+        calls = []
+        access = os.access
+
+        def counting(path, mode):
+            calls.append(path)
+            return access(path, mode)
+        os.access = counting
+        self.addCleanup(setattr, os, 'access', access)
+
+        first = self.tree()
+        self.assertTrue(calls)
+        del calls[:]
+        self.assertEqual(self.tree(), first)
+        self.assertEqual(calls, [])
+
+        os.mkdir(self.root + '/a/e')
+        tree = self.tree()
+        self.assertEqual([d['name'] for d in tree['dirs'][0]['dirs']],
+                         ['b', 'c', 'e'])
+        self.assertEqual(sorted(set(calls)),
+                         [self.root + '/a', self.root + '/a/e'])
+
+
+class MimeTestCase(ConnectorTestCase):
+    """Mimetypes in listings: extension table, LRU cache and sniffing"""
+
+    options = {'dirSize': False, 'mimeSniff': False}
+
+    png = b'\x89PNG\r\n\x1a\n' + b'\0' * 16
+
+    def write(self, name, data=b'x'):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def mimes(self):
+        response = self.request(cmd='open', target=self.hash())
+        return dict((f['name'], f['mime']) for f in response['cdc'])
+
+    def test_by_extension(self):
+        names = ('a.txt', 'b.PNG', 'c.pl', 'd.tar.gz', 'README', 'e.zzz')
+        for name in names:
+            self.write(name)
+        mimes = self.mimes()
+        self.assertEqual(mimes['a.txt'], 'text/plain')
+        self.assertEqual(mimes['b.PNG'], 'image/png')
+        self.assertEqual(mimes['c.pl'], 'text/x-perl')
+        self.assertEqual(mimes['d.tar.gz'],
+                         elfinder.mimetypes.guess_type('d.tar.gz')[0])
+        self.assertEqual(mimes['README'], 'text/plain')
+        self.assertEqual(mimes['e.zzz'], 'unknown')
+        self.assertEqual(self.mimes(), mimes)
+
+    def test_least_recently_used(self):
+        self.connector._options['mimeCacheSize'] = 2
+        cache = self.connector._mimeCache
+        for name in ('a.txt', 'b.txt', 'c.txt'):
+            self.write(name)
+        mimetype = self.private('mimetype')
+        for name in ('a.txt', 'b.txt', 'a.txt', 'c.txt'):
+            mimetype(os.path.join(self.root, name))
+        self.assertEqual(list(cache)[-2:], [self.root + '/a.txt',
+                                            self.root + '/c.txt'])
+        self.mimes()
+        self.assertLessEqual(len(cache), 2)
+
+    def test_sniff(self):
+        self.write('blob', self.png)
+        self.write('notes', 'caf\xe9\n'.encode('utf-8'))
+        self.write('data', b'\0\1\2')
+        self.assertEqual(self.mimes()['blob'], 'unknown')
+        self.connector._options['mimeSniff'] = True
+        self.assertEqual(self.mimes(), {'blob': 'image/png',
+                                        'notes': 'text/plain',
+                                        'data': 'unknown'})
+        self.write('blob', b'plain text now')
+        self.assertEqual(self.mimes()['blob'], 'text/plain')
+
+
+class TreeDepthTestCase(ConnectorTestCase):
+    """treeDepth limits the tree, the tree command expands a node"""
+
+    options = {'treeDepth': 1, 'rootAlias': 'Home', 'dirSize': False}
+
+    def setUp(self):
+        super(TreeDepthTestCase, self).setUp()
+        for rel in ('/a/b/c/d', '/x/y'):
+            os.makedirs(self.root + rel)
+
+    def outline(self, node):
+        """{name: (hasDirs, children)} of the expanded part"""
+        return dict((d['name'], (d['hasDirs'], self.outline(d)))
+                    for d in node['dirs'])
+
+    def test_path_to_cwd_plus_depth(self):
+        response = self.request(cmd='open', target=self.hash('/a/b'),
+                                tree='1')
+        self.assertEqual(response['tree']['name'], 'Home')
+        self.assertEqual(self.outline(response['tree']), {
+            'a': (True, {'b': (True, {'c': (True, {})})}),
+            'x': (True, {})})
+
+    def test_expand_node(self):
+        response = self.request(cmd='tree', target=self.hash('/x'))
+        self.assertEqual(response['tree']['hash'], self.hash('/x'))
+        self.assertEqual(self.outline(response['tree']),
+                         {'y': (False, {})})
+
+    def test_expand_unknown_node(self):
+        self.assertEqual(self.request(cmd='tree', target='nope')['error'],
+                         'Invalid parameters')
+
+    def test_whole_tree(self):
+        self.connector._options['treeDepth'] = 0
+        response = self.request(cmd='open', target=self.hash(), tree='1')
+        self.assertNotIn('hasDirs', response['tree'])
+        self.assertEqual(
+            response['tree']['dirs'][0]['dirs'][0]['dirs'][0]['dirs'][0]
+            ['name'], 'd')
+
+
+class PermsTestCase(ConnectorTestCase):
+    """The compiled perms answer like consecutive re.search() calls"""
+
+    paths = ['/readme.txt', '/secret/a.png', '/secret/b.JPG', '/img/c.png',
+             '/img/aa.gif', '/abab/x.txt', '/public/secret.txt']
+
+    def check(self, perms):
+        self.connector._options['perms'] = perms
+        self.connector._perms = self.private('compilePerms')()
+        checkAllowed = self.private('checkAllowed')
+        for rel in self.paths:
+            path = self.root + rel
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+            for access in ('read', 'write', 'rm'):
+                expected = self.connector._options['defaults'][access]
+                for ppath in perms:
+                    if access in perms[ppath] and re.search(ppath, rel):
+                        expected = perms[ppath][access]
+                        break
+                self.assertEqual(checkAllowed(path, access, None), expected,
+                                 '%s %s' % (access, rel))
+
+    def test_first_match_wins(self):
+        self.check(OrderedDict([
+            (r'^/secret', {'read': False, 'write': False}),
+            (r'\.png$', {'read': True, 'write': False, 'rm': False}),
+            (r'secret', {'rm': False}),
+        ]))
+
+    def test_later_rule_applies_when_earlier_ones_miss(self):
+        self.check(OrderedDict([
+            (r'\.gif$', {'write': False}),
+            (r'^/img/', {'write': True, 'read': False}),
+        ]))
+
+    def test_backreference_falls_back(self):
+        self.check(OrderedDict([
+            (r'(ab)\1', {'read': False}),
+            (r'(a)\1', {'read': False, 'rm': False}),
+        ]))
+        self.assertIsInstance(self.connector._perms['read'], list)
+
+    def test_inline_flags_fall_back(self):
+        self.check(OrderedDict([
+            (r'\.png$', {'write': False}),
+            (r'(?i)\.jpg$', {'write': False, 'read': False}),
+        ]))
+        self.assertIsInstance(self.connector._perms['write'], list)
+
+
+class RangeTestCase(ConnectorTestCase):
+    """Range and If-Range handling of file downloads"""
+
+    etag = '"1-2-3"'
+    mtime = 1000000000  # Sun, 09 Sep 2001 01:46:40 GMT
+
+    def byteRange(self, header, size=100):
+        return self.private('byteRange')(header, size)
+
+    def ifRange(self, cond):
+        self.connector._requestHeader = {'if-range': cond} if cond else {}
+        return self.private('ifRange')(self.etag, self.mtime)
+
+    def test_byte_range(self):
+        self.assertEqual(self.byteRange('bytes=0-9'), (0, 10))
+        self.assertEqual(self.byteRange('bytes=90-'), (90, 10))
+        self.assertEqual(self.byteRange('bytes=-10'), (90, 10))
+        self.assertEqual(self.byteRange(' bytes = 5 - 5 '), (5, 1))
+
+    def test_byte_range_clamped_to_size(self):
+        self.assertEqual(self.byteRange('bytes=50-1000'), (50, 50))
+        self.assertEqual(self.byteRange('bytes=-1000'), (0, 100))
+
+    def test_byte_range_unsatisfiable(self):
+        self.assertIs(self.byteRange('bytes=100-'), False)
+        self.assertIs(self.byteRange('bytes=-0'), False)
+        self.assertIs(self.byteRange('bytes=0-', 0), False)
+
+    def test_byte_range_whole_file(self):
+        for header in ('bytes=-', 'bytes=9-0', 'bytes=0-1,5-6', 'items=0-1',
+                       'bytes=a-b', ''):
+            self.assertIsNone(self.byteRange(header), header)
+
+    def test_if_range(self):
+        self.assertTrue(self.ifRange(None))
+        self.assertTrue(self.ifRange(self.etag))
+        self.assertFalse(self.ifRange('"other"'))
+        self.assertFalse(self.ifRange('W/"1-2-3"'))
+        self.assertTrue(self.ifRange('Sun, 09 Sep 2001 01:46:40 GMT'))
+        self.assertFalse(self.ifRange('Sun, 09 Sep 2001 01:46:41 GMT'))
+        self.assertFalse(self.ifRange('yesterday'))
+
+
+class DedupTestCase(ConnectorTestCase):
+    """Hardlink deduplication of uploads"""
+
+    options = {'dedup': 'hardlink', 'fileMode': 0o644}
+
+    def upload(self, name, data=b'hello world'):
+        path = os.path.join(self.root, name)
+        self.private('saveUpload')(io.BytesIO(data), path, 1 << 20)
+        return path
+
+    def test_linked_to_first_copy(self):
+        a = self.upload('a.txt')
+        b = self.upload('b.txt')
+        self.assertTrue(os.path.samefile(a, b))
+        self.assertEqual(self.connector._dedupSaved,
+                         {'files': 1, 'bytes': 11})
+
+    def test_same_name_again(self):
+        a = self.upload('a.txt')
+        self.upload('a.txt')
+        self.assertEqual(sorted(os.listdir(self.root)), ['.tmb', 'a.txt'])
+        self.assertEqual(os.stat(a).st_nlink, 1)
+        self.assertEqual(self.connector._dedupSaved,
+                         {'files': 0, 'bytes': 0})
+
+
+class UploadTestCase(ConnectorTestCase):
+    """Streaming uploads and their size limits"""
+
+    options = {'uploadMaxSize': 2, 'uploadMaxFileSize': 1,
+               'uploadAllow': [], 'uploadDeny': [],
+               'uploadOrder': ['deny', 'allow'], 'dedup': False,
+               'dirSize': False}
+
+    MB = 1024 * 1024
+
+    def upload(self, **files):
+        return self.request(cmd='upload', current=self.hash(), **{
+            'upload[]': dict((name, io.BytesIO(b'x' * size))
+                             for name, size in files.items())})
+
+    def listing(self):
+        return sorted(os.listdir(self.root))
+
+    def test_file_over_limit(self):
+        response = self.upload(big=self.MB + 1)
+        self.assertEqual(response['error'], 'Unable to upload files')
+        self.assertEqual(list(response['errorData'].values()),
+                         ['File exceeds the maximum allowed filesize'])
+        self.assertEqual(self.listing(), ['.tmb'])
+
+    def test_others_kept(self):
+        response = self.upload(a=10, big=self.MB + 1, c=self.MB)
+        self.assertEqual(response['error'], 'Some files was not uploaded')
+        self.assertEqual(self.listing(), ['.tmb', 'a', 'c'])
+        self.assertEqual(os.path.getsize(self.root + '/c'), self.MB)
+        self.assertEqual(len(response['select']), 2)
+
+    def test_request_over_limit(self):
+        self.connector._options['uploadMaxFileSize'] = 0
+        response = self.upload(a=self.MB, b=self.MB, c=self.MB)
+        self.assertEqual(list(response['errorData'].values()),
+                         ['Upload exceeds the maximum allowed size'])
+        self.assertEqual(len(self.listing()), 3)
+
+
+class ChunkedUploadTestCase(ConnectorTestCase):
+    """Resumable chunked uploads"""
+
+    options = {'uploadChunkDir': '.uploads', 'uploadMaxSize': 1,
+               'uploadMaxFileSize': 0, 'uploadAllow': [], 'uploadDeny': [],
+               'uploadOrder': ['deny', 'allow'], 'dedup': False,
+               'dirSize': False}
+
+    def send(self, data, chunk, chunks, name='f.txt', uploadId='up1'):
+        return self.request(cmd='upload', current=self.hash(),
+                            uploadId=uploadId, chunk=str(chunk),
+                            chunks=str(chunks),
+                            **{'upload[]': {name: io.BytesIO(data)}})
+
+    def partDir(self, uploadId='up1'):
+        return os.path.join(self.connector._options['uploadChunkDir'],
+                            uploadId)
+
+    def test_assembled_in_any_order(self):
+        self.assertEqual(self.send(b'cc', 2, 3)['chunks'], [2])
+        self.assertEqual(self.send(b'aa', 0, 3)['chunks'], [0, 2])
+        response = self.send(b'bb', 1, 3)
+        self.assertNotIn('error', response)
+        with open(os.path.join(self.root, 'f.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'aabbcc')
+        self.assertFalse(os.path.exists(self.partDir()))
+
+    def test_metadata_must_match(self):
+        self.send(b'aa', 0, 2)
+        self.assertEqual(self.send(b'bb', 1, 3)['error'],
+                         'Invalid parameters')
+        self.assertEqual(self.send(b'bb', 1, 2, name='g.txt')['error'],
+                         'Invalid parameters')
+        self.assertEqual(sorted(os.listdir(self.partDir())),
+                         ['0', 'upload.json'])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'f.txt')))
+
+    def test_invalid_parameters(self):
+        for chunk, chunks in ((2, 2), (-1, 2), (0, 0)):
+            self.assertEqual(self.send(b'aa', chunk, chunks)['error'],
+                             'Invalid parameters')
+        for uploadId in ('../up1', 'a/b', '.', 'x' * 65, ''):
+            self.assertEqual(self.send(b'aa', 0, 2, uploadId=uploadId)
+                             ['error'], 'Invalid parameters', uploadId)
+        self.assertEqual(os.listdir(self.connector._options[
+            'uploadChunkDir']), [])
+
+    def test_name_stays_in_current(self):
+        self.send(b'aa', 0, 1, name='../../x/g.txt')
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'g.txt')))
+
+    def status(self, uploadId='up1'):
+        return self.request(cmd='uploadstatus', current=self.hash(),
+                            uploadId=uploadId)
+
+    def test_status(self):
+        self.assertEqual(self.status()['chunks'], [])
+        self.send(b'aa', 1, 3)
+        self.assertEqual(self.status()['chunks'], [1])
+        self.send(b'bb', 0, 3)
+        self.assertEqual(self.status()['chunks'], [0, 1])
+        self.send(b'cc', 2, 3)
+        self.assertEqual(self.status()['chunks'], [])
+        self.assertEqual(self.status('../up1')['error'],
+                         'Invalid parameters')
+
+
+class ExtractTestCase(unittest.TestCase):
+    """Builtin extraction keeps members inside the destination"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='elfinder-test-')
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.dest = os.path.join(self.tmp, 'root', 'dest')
+        os.makedirs(self.dest)
+
+    def extract(self, path, fmt):
+        try:
+            elfinder._extractArchive(path, self.dest, fmt)
+        except tarfile.TarError:
+            pass  # tarfile's data filter refuses the whole archive
+
+    def outside(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.tmp):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                if not path.startswith(self.dest + os.sep) \
+                        and path != self.dest and name not in (
+                            'root', 'evil.zip', 'evil.tar'):
+                    found.append(path)
+        return found
+
+    def test_zip(self):
+        path = os.path.join(self.tmp, 'evil.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('ok.txt', 'ok')
+            zf.writestr('../up.txt', 'up')
+            zf.writestr('/abs.txt', 'abs')
+        self.extract(path, 'zip')
+        self.assertEqual(self.outside(), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, 'ok.txt')))
+
+    def evilTar(self):
+        path = os.path.join(self.tmp, 'evil.tar')
+        with tarfile.open(path, 'w') as tf:
+            for name in ('ok.txt', '../up.txt', '/abs.txt'):
+                info = tarfile.TarInfo(name)
+                info.size = 2
+                tf.addfile(info, io.BytesIO(b'xx'))
+            link = tarfile.TarInfo('link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '..'
+            tf.addfile(link)
+            info = tarfile.TarInfo('link/through.txt')
+            info.size = 2
+            tf.addfile(info, io.BytesIO(b'xx'))
+        return path
+
+    def test_tar(self):
+        self.extract(self.evilTar(), 'tar')
+        self.assertEqual(self.outside(), [])
+
+    def test_tar_without_data_filter(self):
+        path = self.evilTar()
+        saved = tarfile.__dict__.pop('data_filter', None)
+        try:
+            self.extract(path, 'tar')
+        finally:
+            if saved is not None:
+                tarfile.data_filter = saved
+        self.assertEqual(self.outside(), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, 'ok.txt')))
+        self.assertFalse(os.path.islink(os.path.join(self.dest, 'link')))
+
+    def test_clash_leaves_dest_alone(self):
+        with open(os.path.join(self.dest, 'a'), 'w') as f:
+            f.write('file')
+        path = os.path.join(self.tmp, 'evil.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            for i in range(10):
+                zf.writestr('%d.txt' % i, 'x')
+            zf.writestr('a/b.txt', 'b')
+        with self.assertRaises(OSError):
+            elfinder._extractArchive(path, self.dest, 'zip')
+        self.assertEqual(os.listdir(self.dest), ['a'])
+
+    def test_merge_clash(self):
+        src = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(src, 'd', 'e'))
+        os.makedirs(os.path.join(self.dest, 'd'))
+        self.assertIsNone(elfinder._mergeClash(src, self.dest))
+        open(os.path.join(self.dest, 'd', 'e'), 'w').close()
+        self.assertEqual(elfinder._mergeClash(src, self.dest),
+                         os.path.join(self.dest, 'd', 'e'))
+
+    def test_replaces_instead_of_writing_through(self):
+        shared = os.path.join(self.tmp, 'root', 'shared.txt')
+        with open(shared, 'w') as f:
+            f.write('keep')
+        os.link(shared, os.path.join(self.dest, 'f.txt'))
+        path = os.path.join(self.tmp, 'evil.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('f.txt', 'new')
+        self.extract(path, 'zip')
+        with open(shared) as f:
+            self.assertEqual(f.read(), 'keep')
+        with open(os.path.join(self.dest, 'f.txt')) as f:
+            self.assertEqual(f.read(), 'new')
+
+
+class ArchiveTestCase(ConnectorTestCase):
+    """Builtin archive entries and extraction through the connector"""
+
+    options = {'archiveBuiltin': True, 'dirSize': True,
+               'dirSizeDefer': False, 'dirSizeTTL': 3600, 'disabled': []}
+
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.outside = tempfile.mkdtemp(prefix='elfinder-outside-')
+        self.addCleanup(shutil.rmtree, self.outside, True)
+        with open(os.path.join(self.outside, 'secret'), 'w') as f:
+            f.write('secret')
+
+    def test_links_outside_root_left_out(self):
+        os.mkdir(self.root + '/d')
+        with open(self.root + '/d/f.txt', 'w') as f:
+            f.write('f')
+        os.symlink('f.txt', self.root + '/d/in')
+        os.symlink(self.outside, self.root + '/d/out')
+        os.symlink(os.path.join(self.outside, 'secret'),
+                   self.root + '/d/secret')
+        os.symlink(self.outside, self.root + '/top')
+        entries = self.private('archiveEntries')(
+            [self.root + '/d', self.root + '/top'])
+        self.assertEqual(sorted(name for path, name in entries),
+                         ['d', 'd/f.txt', 'd/in'])
+
+    def test_extract_into_existing_directory(self):
+        os.makedirs(self.root + '/d/sub')
+        with open(self.root + '/d/sub/old.txt', 'wb') as f:
+            f.write(b'x' * 10)
+        aggregateSize = self.private('aggregateSize')
+        self.assertEqual(aggregateSize(self.root + '/d'), 10)
+
+        path = os.path.join(self.root, 'a.zip')
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('d/sub/new.txt', b'y' * 100)
+        response = self.request(cmd='extract', current=self.hash(),
+                                target=self.hash('/a.zip'))
+        self.assertNotIn('error', response)
+        self.assertTrue(os.path.isfile(self.root + '/d/sub/new.txt'))
+        self.assertEqual(aggregateSize(self.root + '/d'), 110)
+
+    def tree(self):
+        os.makedirs(self.root + '/d/e')
+        for rel in ('/d/f.txt', '/d/e/g.txt', '/h.txt'):
+            with open(self.root + rel, 'w') as f:
+                f.write(rel)
+        os.symlink(os.path.join(self.outside, 'secret'),
+                   self.root + '/d/secret')
+
+    @unittest.skipUnless(elfinder._zipStreamable, 'needs Python 3.8')
+    def test_zip_download(self):
+        self.tree()
+        status, header, response = self.connector.run({
+            'cmd': 'zipdl', 'current': self.hash(),
+            'targets[]': [self.hash('/d'), self.hash('/h.txt')]})
+        self.assertEqual(status, 200)
+        self.assertEqual(header['Content-type'], 'application/zip')
+        self.assertEqual(header['Content-Disposition'],
+                         'attachment; filename=Archive.zip')
+        data = b''.join(response['file'])
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertEqual(sorted(zf.namelist()), [
+                'd/', 'd/e/', 'd/e/g.txt', 'd/f.txt', 'h.txt'])
+            self.assertEqual(zf.read('d/e/g.txt'), b'/d/e/g.txt')
+
+    @unittest.skipUnless(elfinder._zipStreamable, 'needs Python 3.8')
+    def test_zip_download_missing_target(self):
+        response = self.request(cmd='zipdl', current=self.hash(),
+                                **{'targets[]': ['nope']})
+        self.assertEqual(response['error'], 'File not found')
+
+    def test_archive_and_extract(self):
+        self.tree()
+        response = self.request(cmd='archive', current=self.hash(),
+                                type='application/x-tar',
+                                **{'targets[]': [self.hash('/d')]})
+        self.assertNotIn('error', response)
+        archive, = [n for n in os.listdir(self.root) if n.endswith('.tar')]
+        with tarfile.open(os.path.join(self.root, archive)) as tf:
+            self.assertEqual(sorted(tf.getnames()),
+                             ['d', 'd/e', 'd/e/g.txt', 'd/f.txt'])
+        os.mkdir(self.root + '/x')
+        os.rename(self.root + '/' + archive, self.root + '/x/' + archive)
+        response = self.request(cmd='extract', current=self.hash('/x'),
+                                target=self.hash('/x/' + archive))
+        self.assertNotIn('error', response)
+        with open(self.root + '/x/d/e/g.txt') as f:
+            self.assertEqual(f.read(), '/d/e/g.txt')
+
+
+class ArchiverProbeTestCase(ConnectorTestCase):
+    """Archiver commands are probed once and remembered in cacheDir"""
+
+    options = {'cacheDir': '.cache', 'archiveBuiltin': False,
+               'disabled': [], 'dirSize': False}
+
+    def setUp(self):
+        super(ArchiverProbeTestCase, self).setUp()
+        self.addCleanup(setattr, elfinder.connector, '_archiverTools',
+                        elfinder.connector._archiverTools)
+        elfinder.connector._archiverTools = None
+        self.installed = set(['tar'])
+        self.probed = []
+        test = self
+
+        class subprocess(object):
+            PIPE = None
+
+            class Popen(object):
+                def __init__(self, cmd, **kwargs):
+                    test.probed.append(cmd[0])
+                    if cmd[0] not in test.installed:
+                        raise OSError(errno.ENOENT, 'not found')
+                    self.returncode = 0
+
+                def communicate(self, data):
+                    return b'', b''
+        self.connector._sp = subprocess
+
+    def archives(self):
+        response = self.request(cmd='open', target=self.hash(), init='1')
+        return sorted(response['params']['archives'])
+
+    def saved(self):
+        with open(os.path.join(self.root, '.cache', 'archivers.json')) as f:
+            return json.load(f)
+
+    def test_probed_once(self):
+        self.assertEqual(self.archives(), ['application/x-tar'])
+        self.assertEqual(len(self.probed), 10)
+        self.assertEqual(self.archives(), ['application/x-tar'])
+        self.assertEqual(len(self.probed), 10)
+        self.assertTrue(self.saved()['tar'])
+        self.assertFalse(self.saved()['rar'])
+
+    def test_loaded_from_cache_dir(self):
+        with open(os.path.join(self.root, '.cache', 'archivers.json'),
+                  'w') as f:
+            json.dump({'rar': True}, f)
+        self.assertEqual(self.archives(), ['application/x-rar'])
+        self.assertEqual(self.probed, [])
+
+    def test_refresh(self):
+        self.archives()
+        self.installed = set(['rar'])
+        tools = self.connector.refreshArchivers()
+        self.assertEqual(tools, self.saved())
+        self.assertEqual(sorted(k for k, v in tools.items() if v), ['rar'])
+        self.assertEqual(self.archives(), ['application/x-rar'])
+        self.assertEqual(len(self.probed), 20)
+
+
+class TrashTestCase(ConnectorTestCase):
+    """Restored trash items stay inside root"""
+
+    options = {'trash': '.trash', 'trashRetention': 3600, 'dirSize': False}
+
+    def trash(self, rel):
+        path = self.root + rel
+        with open(path, 'w') as f:
+            f.write('x')
+        response = self.request(cmd='rm', current=self.hash(),
+                                **{'targets[]': [self.hash(rel)]})
+        self.assertNotIn('error', response)
+        self.assertNotIn(os.path.basename(rel),
+                         [f['name'] for f in response['cdc']])
+        item, = [n for n in os.listdir(self.connector._options['trash'])
+                 if not n.startswith('.')]
+        return item
+
+    def restore(self, item):
+        return self.request(cmd='restore', **{'targets[]': [item]})
+
+    def test_origin(self):
+        origin = self.private('trashOrigin')
+        self.assertEqual(origin('/a/b.txt'), self.root + '/a/b.txt')
+        for rel in ('', '/', '/../etc/passwd', '/a/../../etc', 'x',
+                    '/.trash', '/.trash/x', '/a\\..\\..\\etc'):
+            self.assertIsNone(origin(rel), rel)
+
+    def test_restore(self):
+        item = self.trash('/f.txt')
+        self.assertFalse(os.path.exists(self.root + '/f.txt'))
+        response = self.restore(item)
+        self.assertNotIn('error', response)
+        self.assertEqual(response['select'], [self.hash('/f.txt')])
+        self.assertTrue(os.path.isfile(self.root + '/f.txt'))
+        self.assertEqual(self.restore(item)['error'],
+                         'Unable to restore files')
+
+    def test_forged_trashinfo(self):
+        item = self.trash('/f.txt')
+        info = os.path.join(self.connector._options['trash'], item,
+                            '.trashinfo')
+        with open(info, 'w') as f:
+            json.dump({'path': '/../escaped.txt'}, f)
+        response = self.restore(item)
+        self.assertIn(item, response['errorData'])
+        self.assertFalse(os.path.exists(
+            os.path.join(os.path.dirname(self.root), 'escaped.txt')))
+
+    def test_purge_errors_stay_off_the_response(self):
+        self.connector._options['debug'] = True
+        item = self.trash('/f.txt')
+        self.private('reset')()
+        unlink = os.unlink
+
+        def failing(path):
+            raise OSError(errno.EACCES, 'denied', path)
+        os.unlink = failing
+        try:
+            errors = self.private('trashPurgeRun')(
+                self.connector._options['trash'], -1)
+        finally:
+            os.unlink = unlink
+        self.assertTrue(errors)
+        self.assertEqual(self.connector._response['debug'], {})
+        self.assertTrue(os.path.isdir(os.path.join(
+            self.connector._options['trash'], item)))
+
+    def test_invalid_item_name(self):
+        self.assertIn('../x', self.restore('../x')['errorData'])
+
+
+class CopyDataTestCase(ConnectorTestCase):
+    """Duplicate when the kernel copy calls are unavailable"""
+
+    options = {'dedup': False, 'dirSize': False}
+
+    def setUp(self):
+        super(CopyDataTestCase, self).setUp()
+        self.data = os.urandom(3 * 1024 * 1024 + 5)
+        with open(self.root + '/a.bin', 'wb') as f:
+            f.write(self.data)
+        self.patch(elfinder, '_reflink', lambda src, dst: False)
+        self.calls = []
+
+    def patch(self, module, name, func):
+        if hasattr(module, name):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+        else:
+            self.addCleanup(delattr, module, name)
+        setattr(module, name, func)
+
+    def failing(self, name, code):
+        def func(*args):
+            self.calls.append(name)
+            raise OSError(code, os.strerror(code))
+        self.patch(os, name, func)
+
+    def duplicate(self):
+        response = self.request(cmd='duplicate', current=self.hash(),
+                                target=self.hash('/a.bin'))
+        self.assertNotIn('error', response)
+        with open(self.root + '/a copy.bin', 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'needs os.sendfile')
+    def test_sendfile(self):
+        self.failing('copy_file_range', errno.ENOSYS)
+        self.duplicate()
+        self.assertEqual(self.calls, ['copy_file_range'])
+
+    def test_userspace(self):
+        self.failing('copy_file_range', errno.EXDEV)
+        self.failing('sendfile', errno.ENOSYS)
+        self.duplicate()
+        self.assertEqual(self.calls, ['copy_file_range', 'sendfile'])
+
+
+class MoveAcrossTestCase(ConnectorTestCase):
+    """Cut and paste when rename() reports another filesystem"""
+
+    options = {'dedup': False, 'dirSize': False, 'copyWorkers': 2}
+
+    def setUp(self):
+        super(MoveAcrossTestCase, self).setUp()
+        os.makedirs(self.root + '/src/d/e')
+        os.mkdir(self.root + '/dst')
+        for rel, data in (('/d/a.txt', b'aaa'), ('/d/e/b.txt', b'bbbb')):
+            with open(self.root + '/src' + rel, 'wb') as f:
+                f.write(data)
+        os.symlink('e/b.txt', self.root + '/src/d/link')
+        self.moved = os.path.join(self.root, 'dst', 'd')
+
+        rename = os.rename
+        self.crossed = []
+
+        def crossDevice(src, dst):
+            if src == self.root + '/src/d' and dst == self.moved:
+                self.crossed.append(src)
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            rename(src, dst)
+        os.rename = crossDevice
+        self.addCleanup(setattr, os, 'rename', rename)
+
+    def paste(self):
+        h = self.private('hash')
+        self.connector._request = {
+            'current': h(self.root), 'src': h(self.root + '/src'),
+            'dst': h(self.root + '/dst'), 'cut': '1',
+            'targets[]': [h(self.root + '/src/d')]}
+        self.private('paste')()
+        return self.connector._response
+
+    def patchCopy(self, copy):
+        saved = elfinder._copyFile
+        elfinder._copyFile = copy
+        self.addCleanup(setattr, elfinder, '_copyFile', saved)
+
+    def assertSourceKept(self):
+        self.assertEqual(sorted(os.listdir(self.root + '/src/d')),
+                         ['a.txt', 'e', 'link'])
+        with open(self.root + '/src/d/e/b.txt', 'rb') as f:
+            self.assertEqual(f.read(), b'bbbb')
+        self.assertEqual(os.listdir(self.root + '/dst'), [])
+        self.assertEqual(sorted(os.listdir(self.root + '/src')), ['d'])
+
+    def test_move(self):
+        self.assertNotIn('error', self.paste())
+        self.assertTrue(self.crossed)
+        self.assertFalse(os.path.lexists(self.root + '/src/d'))
+        self.assertEqual(os.listdir(self.root + '/src'), [])
+        with open(os.path.join(self.moved, 'e', 'b.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'bbbb')
+        link = os.path.join(self.moved, 'link')
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.readlink(link), 'e/b.txt')
+        self.assertEqual(os.listdir(self.root + '/dst'), ['d'])
+
+    def test_copy_fails_partway(self):
+        copy = elfinder._copyFile
+
+        def failing(src, dst):
+            if src.endswith('b.txt'):
+                raise IOError(errno.EIO, 'read error')
+            return copy(src, dst)
+        self.patchCopy(failing)
+        self.assertEqual(self.paste()['error'], 'Unable to move files')
+        self.assertSourceKept()
+
+    def test_different_copy_keeps_source(self):
+        def truncating(src, dst):
+            with open(dst, 'wb') as f:
+                f.write(b'x')
+            return 1
+        self.patchCopy(truncating)
+        self.assertEqual(self.paste()['error'], 'Unable to move files')
+        self.assertSourceKept()
+
+    def test_same_tree(self):
+        sameTree = self.private('sameTree')
+        src = self.root + '/src/d'
+        shutil.copytree(src, self.root + '/copy', symlinks=True)
+        self.assertTrue(sameTree(src, self.root + '/copy'))
+        os.unlink(self.root + '/copy/link')
+        os.symlink('a.txt', self.root + '/copy/link')
+        self.assertFalse(sameTree(src, self.root + '/copy'))
+        os.unlink(self.root + '/copy/link')
+        self.assertFalse(sameTree(src, self.root + '/copy'))
+
+
+class ListingETagTestCase(ConnectorTestCase):
+    """Listing validators follow changes made through the connector"""
+
+    options = {'listingETag': True, 'cacheDir': '.cache', 'dirSize': False}
+
+    def etag(self):
+        self.private('reset')()
+        self.private('listingNotModified')(self.root)
+        return self.connector.httpHeader.get('ETag')
+
+    def test_disabled(self):
+        self.connector._options['listingETag'] = False
+        self.assertIsNone(self.etag())
+
+    def test_change_below(self):
+        os.mkdir(os.path.join(self.root, 'a'))
+        etag = self.etag()
+        self.assertTrue(etag)
+        self.assertEqual(self.etag(), etag)
+
+        path = os.path.join(self.root, 'a', 'f.txt')
+        before = os.stat(self.root).st_mtime
+        with open(path, 'w') as f:
+            f.write('x')
+        self.private('changed')(path)
+        self.private('bumpGeneration')()
+        self.assertNotEqual(self.etag(), etag)
+        self.assertEqual(os.stat(self.root).st_mtime, before)
+
+    def test_not_modified(self):
+        etag = self.etag()
+        self.private('reset')()
+        self.connector._requestHeader = {'if-none-match': etag}
+        self.assertTrue(self.private('listingNotModified')(self.root))
+        self.assertEqual(self.connector.httpStatusCode, 304)
+
+
+class UnhashTestCase(ConnectorTestCase):
+    """Reversible path hashes (hashMode 'path')"""
+
+    options = {'hashMode': 'path', 'hashSecret': 'secret'}
+
+    def hash(self, path):
+        return self.private('hash')(path)
+
+    def unhash(self, fhash):
+        return self.private('unhash')(fhash)
+
+    def forge(self, rel):
+        """Hash of rel signed with a different secret"""
+        self.connector._options['hashSecret'] = 'guess'
+        try:
+            return self.hash(self.root + rel)
+        finally:
+            self.connector._options['hashSecret'] = 'secret'
+
+    def test_round_trip(self):
+        for rel in ('', '/a', '/a/b c.txt', u'/файл'):
+            self.assertEqual(self.unhash(self.hash(self.root + rel)),
+                             self.root + rel)
+
+    def test_forged_signature(self):
+        fhash = self.hash(self.root + '/a')
+        self.assertIsNone(self.unhash(self.forge('/a')))
+        self.assertIsNone(self.unhash(fhash[:-1]))
+        self.assertIsNone(self.unhash('0' * 16 + fhash[16:]))
+        self.assertIsNone(self.unhash(''))
+
+    def test_non_ascii(self):
+        fhash = self.hash(self.root + '/a')
+        self.assertIsNone(self.unhash(fhash[:-1] + u'\xe9'))
+        self.assertIsNone(self.unhash(u'\xe9' * 20))
+
+    def test_traversal(self):
+        mac = self.private('hashMac')
+        for rel in ('/../etc', '/a/../../etc', '/..', 'x'):
+            payload = base64.urlsafe_b64encode(
+                rel.encode('utf-8')).rstrip(b'=')
+            fhash = mac(payload) + payload.decode('ascii')
+            self.assertIsNone(self.unhash(fhash), rel)
+
+
+@unittest.skipIf(Image is None, 'PIL is not installed')
+class ThumbnailTestCase(ConnectorTestCase):
+    """Thumbnails without cacheDir, stores do not outlive a request"""
+
+    options = {'imgLib': 'auto', 'tmbSize': 48,
+               'tmbSizes': {}, 'tmbFormat': 'png', 'tmbProcesses': 0}
+
+    def setUp(self):
+        super(ThumbnailTestCase, self).setUp()
+        self.image = os.path.join(self.root, 'a.png')
+        Image.new('RGB', (100, 80)).save(self.image)
+
+    def newProcess(self):
+        self.connector._stores.clear()
+        self.connector._manifestBuilt.clear()
+
+    def tmbExists(self):
+        st = os.stat(self.image)
+        digest = self.private('tmbDigest')(
+            self.image, self.private('statKey')(st))
+        return self.private('tmbExists')(digest, st)
+
+    def test_found_by_path(self):
+        self.private('initImgLib')()
+        self.assertTrue(self.private('tmb')(self.image, 'key'))
+        self.newProcess()
+        self.assertTrue(self.tmbExists())
+
+    def test_answered_from_manifest(self):
+        self.private('initImgLib')()
+        self.private('tmb')(self.image, 'key')
+        self.newProcess()
+        self.assertTrue(self.tmbExists())
+        # one tmbDir scan per process, no stat per thumbnail afterwards
+        shutil.rmtree(self.connector._options['tmbDir'])
+        self.assertTrue(self.tmbExists())
+        self.private('rmTmb')(self.image)
+        self.assertFalse(self.tmbExists())
+
+    def test_stale_after_change(self):
+        self.private('initImgLib')()
+        self.private('tmb')(self.image, 'key')
+        later = os.stat(self.image).st_mtime + 10
+        os.utime(self.image, (later, later))
+        self.assertFalse(self.tmbExists())
+
+    def test_use_time_saved(self):
+        self.connector._options['cacheDir'] = self.root
+        self.private('initImgLib')()
+        st = os.stat(self.image)
+        digest = self.private('tmb')(self.image, self.private('statKey')(st))
+        manifest = self.private('tmbManifest')()
+        for entry in manifest.values():
+            entry[1] = 0
+        self.connector._storesDirty.clear()
+        self.assertTrue(self.private('tmbExists')(digest, st, True))
+        self.assertIn((self.root, 'tmbmanifest'),
+                      self.connector._storesDirty)
+        self.assertTrue(all(entry[1] for entry in manifest.values()))
+
+    def test_dimensions_pending(self):
+        self.connector._options['imgDimsBackground'] = True
+        info = self.private('info')(self.image)
+        self.assertTrue(info['dimPending'])
+        self.assertTrue(self.connector._response['imgdims'])
+        for i in range(100):
+            if not self.connector._dimJobs:
+                break
+            time.sleep(0.05)
+        self.private('reset')()
+        info = self.private('info')(self.image)
+        self.assertEqual(info['dim'], '100x80')
+        self.assertNotIn('dimPending', info)
+        self.assertNotIn('imgdims', self.connector._response)
+
+    def test_concurrent_writers(self):
+        tmb = os.path.join(self.connector._options['tmbDir'], 'a_48.png')
+        im = Image.new('RGB', (400, 400), (255, 0, 0))
+
+        def write():
+            for i in range(10):
+                elfinder._saveThumbnail(im, tmb, 48)
+        threads = [threading.Thread(target=write) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(os.listdir(self.connector._options['tmbDir']),
+                         ['a_48.png'])
+        with Image.open(tmb) as result:
+            self.assertEqual(result.size, (48, 48))
+
+    def thumbnails(self, count=6):
+        for i in range(count):
+            Image.new('RGB', (60, 40)).save(
+                os.path.join(self.root, 'i%d.png' % i))
+        return self.request(cmd='tmb', current=self.hash())
+
+    def assertThumbnails(self, images):
+        tmbDir = self.connector._options['tmbDir']
+        for url in images.values():
+            name = url.rsplit('/', 1)[1]
+            self.assertTrue(os.path.isfile(os.path.join(tmbDir, name)))
+        self.assertEqual(
+            sorted(self.private('tmbManifest')()),
+            sorted(n for n in os.listdir(tmbDir) if n.endswith('.png')))
+
+    def test_batches_in_request_thread(self):
+        first = self.thumbnails()
+        self.assertEqual(len(first['images']), 5)
+        self.assertTrue(first['tmb'])
+        second = self.request(cmd='tmb', current=self.hash())
+        self.assertEqual(len(second['images']), 2)
+        self.assertNotIn('tmb', second)
+        self.assertFalse(set(first['images']) & set(second['images']))
+        self.assertThumbnails(dict(first['images'], **second['images']))
+        self.assertEqual(
+            self.request(cmd='tmb', current=self.hash())['images'], {})
+
+    def test_process_pool(self):
+        self.connector._options.update({'tmbProcesses': 2, 'tmbTime': 60})
+        response = self.thumbnails()
+        self.assertEqual(len(response['images']), 7)
+        self.assertNotIn('tmb', response)
+        self.assertThumbnails(response['images'])
+        self.assertEqual(
+            self.request(cmd='tmb', current=self.hash())['images'], {})
+
+    def test_legacy_thumbnails_purged(self):
+        legacy = os.path.join(self.connector._options['tmbDir'],
+                              'd41d8cd98f00b204e9800998ecf8427e.png')
+        open(legacy, 'w').close()
+        self.private('tmbLegacyPurge')()
+        self.assertFalse(os.path.exists(legacy))
+
+
+if __name__ == '__main__':
+    unittest.main()